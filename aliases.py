@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import re
+
+
+class CommandRewriter(object):
+    """Rewrites bash commands before they are run. The first word of each
+    command is replaced by its alias in aliases, {name: command}, and the
+    commands in colors, {command: option}, get the option to show color
+    when their output is shown rather than piped or redirected, and they
+    do not have it already.
+
+    The command is read in a single pass of one regular expression, and
+    words are looked up in the tables, so the cost does not grow with the
+    number of aliases. Quoted words are left alone, as in bash."""
+
+    _tokens = re.compile(r'''
+        (?P<redirect>(?:[0-9]*(?:>>|>&|<&|<>|>\||>|<)|&>>?)(?:[0-9]+-?|-)?)
+      | (?P<open>\$?\()
+      | (?P<close>\))
+      | (?P<separator>\|\||&&|\|&|[|;&\n])
+      | (?P<space>\s+)
+      | (?P<word>(?:\\.|'[^']*'|"(?:\\.|[^"\\])*"|\$(?!\()
+                   |[^\s|;&()<>'"\\$])+)
+      | (?P<other>.)''', re.VERBOSE | re.DOTALL)
+
+    # Words after which a command starts: keywords and assignments
+    _keywords = {'!', '{', 'if', 'then', 'else', 'elif', 'do', 'while',
+                 'until', 'time'}
+    _assignment = re.compile(r'[A-Za-z_][A-Za-z0-9_]*=')
+
+    def __init__(self, aliases=None, colors=None):
+        self.aliases = {name: command
+                        for name, command in (aliases or dict()).items()
+                        if command}
+        self.colors = {command: option
+                       for command, option in (colors or dict()).items()
+                       if option}
+
+    def rewrite(self, cmd):
+        """cmd with aliases replaced and color options added. Commands in
+        a command substitution, '$(...)', never get color, as their output
+        is not shown. Those in a subshell, '(...)', get it unless the
+        output of the subshell is piped or redirected."""
+        parts = list()
+        command_start = True
+        colors = list()  # [part to add option to, option] for this command
+        shown = list()  # Those of the commands ended, output not piped
+        substitution = False  # In '$(...)'?
+        # (colors, shown, substitution, command_start, '(' or '$(', its
+        # part) outside each open parenthesis
+        outer = list()
+
+        for match in self._tokens.finditer(cmd):
+            kind, text = match.lastgroup, match.group()
+            if kind == 'separator':
+                if text not in ('|', '|&'):
+                    shown.extend(colors)
+                colors = list()
+                command_start = True
+            elif kind == 'open':
+                outer.append((colors, shown, substitution, command_start,
+                              text, len(parts)))
+                colors, shown = list(), list()
+                substitution = substitution or text == '$('
+                command_start = True
+            elif kind == 'close' and outer:
+                shown.extend(colors)
+                inside = shown
+                colors, shown, substitution, command_start, opening, \
+                    position = outer.pop()
+                if opening == '(':  # The output of the subshell is theirs
+                    colors = inside
+                    # After 'name()' comes the body of a function
+                    command_start = position == len(parts) - 1
+            elif kind == 'redirect':
+                if '>' in text and not text.startswith('2'):
+                    colors = list()  # stdout goes to a file
+            elif kind == 'word' and command_start:
+                command_start = text in self._keywords or \
+                    self._assignment.match(text) is not None
+                if command_start:
+                    parts.append(text)
+                    continue
+                text = self.aliases.get(text, text)
+                name, space, args = text.partition(' ')
+                option = self.colors.get(name)
+                colors = list()
+                if option is not None and not substitution and \
+                   not self._has_option(args, option):
+                    colors.append([len(parts), option])
+                parts.append(name)
+                text = space + args
+            elif kind == 'word' and colors:
+                colors = [color for color in colors
+                          if not self._has_option(text, color[1])]
+            parts.append(text)
+
+        shown.extend(colors)
+        for position, option in shown:
+            parts[position] += ' ' + option
+        return ''.join(parts)
+
+    @staticmethod
+    def _has_option(args, option):
+        """Does args, words, set the option already, e.g. '--color=auto'
+        for option '--color=always'?"""
+        name = option.split('=', 1)[0]
+        return any(word == name or word.startswith(name + '=')
+                   for word in args.split())
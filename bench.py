@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""Keystroke latency benchmarks. Runs scripted key sequences against a
+TextUserInterface on a screen that is never drawn, and reports the time
+from each key press until the frame is rendered:
+
+  ./bench.py                          All scenarios, 100 to 10000 entries
+  ./bench.py -s 1e6 scroll history    Selected scenarios and sizes
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import urwid
+
+import config
+import markup
+import process
+import resultobject
+import winex
+from palette import palette
+
+
+class _FakeScreen(urwid.display.raw.Screen):
+    """A screen of a fixed size that is never drawn to"""
+
+    def __init__(self, size):
+        super(_FakeScreen, self).__init__()
+        self.size = size
+
+    def get_cols_rows(self):
+        return self.size
+
+    def draw_screen(self, size, canvas):
+        pass
+
+
+class _Bench(object):
+    """A TextUserInterface and its MainLoop, without a terminal"""
+
+    def __init__(self, size=(100, 40)):
+        self.size = size
+        self.color_mapper = markup.ColorMapper()
+        self.runner = process.ProcessRunner()
+        self.ui = winex.TextUserInterface(self.color_mapper, self.runner)
+        # What MainLoop(pop_ups=True) does; the auto complete pop up is
+        # shown by, and gets the keys through, the PopUpTarget
+        self.top = urwid.PopUpTarget(self.ui)
+        self.loop = urwid.MainLoop(self.top, palette=palette,
+                                   screen=_FakeScreen(size))
+        self.color_mapper.setup(self.loop)
+        self.runner.setup(self.loop)
+        self.ui.presentation.setup(self.loop)
+        self.render()
+        self.ui.finish_startup()
+
+    def render(self):
+        return self.top.render(self.size, focus=True)
+
+    def press(self, keys):
+        """Press keys, rendering after each. Returns the latencies in
+        seconds."""
+        latencies = list()
+        for key in keys:
+            start = time.perf_counter()
+            self.top.keypress(self.size, key)
+            self.render()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+
+def _make_tree(path, size):
+    """A directory of size entries, a tenth of them directories"""
+    for i in range(size):
+        name = os.path.join(path, f"file{i:07d}.txt")
+        if i % 10 == 0:
+            os.mkdir(name[:-4])
+        else:
+            open(name, 'w').close()
+
+
+def _make_output(size):
+    """size lines of colored output, like a build log"""
+    words = ['compiling', 'linking', 'warning', 'module', 'object', 'done']
+    rand = random.Random(size)
+    lines = list()
+    for i in range(size):
+        text = ' '.join(rand.choice(words) for _ in range(6))
+        if i % 100 == 0:
+            lines.append(f"\x1b[1;31merror\x1b[0m {i}: {text}")
+        else:
+            lines.append(f"\x1b[32m[{i:7d}]\x1b[0m {text}")
+    return '\n'.join(lines)
+
+
+def complete(bench, size, workdir):
+    """Typing a file name with the auto complete pop up open"""
+    tree = os.path.join(workdir, f"tree{size}")
+    if not os.path.isdir(tree):
+        os.mkdir(tree)
+        _make_tree(tree, size)
+    os.chdir(tree)
+    bench.press(['esc'])
+    latencies = list()
+    for _ in range(3):
+        latencies += bench.press(list('file000') + ['esc'] * 2)
+    return latencies
+
+
+def history(bench, size, workdir):
+    """Browsing and searching the command history"""
+    resultobj = resultobject.ResultObject()
+    for i in range(size):
+        resultobj.set_result('bsh', f"make target{i} -j8", 'success',
+                             presentation=f"built target{i}", exec_wd='/')
+        bench.ui.cmd_history.history.add(resultobj)
+    keys = ['meta s'] + ['up'] * 20 + ['down'] * 10
+    keys += list('target12') + ['up'] * 10 + ['backspace'] * 8
+    keys += list('nomatch') + ['esc']
+    return bench.press(keys)
+
+
+def scroll(bench, size, workdir):
+    """Scrolling, searching and jumping in the presentation"""
+    bench.ui.presentation.update(_make_output(size))
+    keys = ['meta w'] + ['down'] * 50 + ['page down'] * 20
+    keys += ['up'] * 20 + ['page up'] * 10
+    keys += list('/error') + ['enter'] + ['n'] * 10 + ['N'] * 5
+    latencies = bench.press(keys)
+    bench.press(['meta e'])
+    return latencies
+
+
+def modes(bench, size, workdir):
+    """Switching between the directory and bash modes"""
+    keys = list(':bsh') + ['enter'] + ['esc'] + list(':bsh') + ['enter']
+    keys += ['esc'] * 2
+    latencies = list()
+    for _ in range(5):
+        latencies += bench.press(keys)
+    return latencies
+
+
+scenarios = {'complete': complete,
+             'history': history,
+             'scroll': scroll,
+             'modes': modes}
+
+
+def percentiles(latencies, points=(50, 90, 99)):
+    latencies = sorted(latencies)
+    return [latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+            for p in points] + [latencies[-1]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"any of {', '.join(scenarios)} (default: all)")
+    parser.add_argument('-s', '--sizes', default='1e2,1e3,1e4',
+                        help="comma separated entry counts (default: "
+                        "%(default)s)")
+    args = parser.parse_args(argv)
+
+    names = args.scenarios or list(scenarios)
+    for name in names:
+        if name not in scenarios:
+            parser.error(f"no such scenario '{name}'")
+    sizes = [int(float(size)) for size in args.sizes.split(',')]
+
+    # Keep the user's history out of it
+    config.settings.set('history', 'persist', 'no')
+
+    cwd = os.getcwd()
+    print(f"{'scenario':<10}{'size':>9}{'keys':>6}"
+          f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    with tempfile.TemporaryDirectory(prefix='winex-bench-') as workdir:
+        for name in names:
+            for size in sizes:
+                os.chdir(workdir)
+                latencies = scenarios[name](_Bench(), size, workdir)
+                os.chdir(cwd)
+                row = ''.join(f"{latency * 1000:9.2f}"
+                              for latency in percentiles(latencies))
+                print(f"{name:<10}{size:>9}{len(latencies):>6}{row}")
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
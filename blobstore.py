@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import json
+import zlib
+import hashlib
+
+
+def encode(presentation):
+    """presentation, text or a list of markup, as bytes"""
+    if isinstance(presentation, str):
+        return b't' + presentation.encode(errors='surrogateescape')
+    return b'm' + json.dumps(presentation, ensure_ascii=False).encode(
+        errors='surrogateescape')
+
+
+def decode(data):
+    """Undo encode()"""
+    if data[:1] == b't':
+        return data[1:].decode(errors='surrogateescape')
+    return [line if isinstance(line, str) else [tuple(seg) for seg in line]
+            for line in json.loads(data[1:].decode(errors='surrogateescape'))]
+
+
+def key(data):
+    """Identifies encoded presentations with the same content"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def pack(data, compress_threshold):
+    """data, compressed if larger than compress_threshold bytes. Returns
+    whether it was compressed, and the data"""
+    if len(data) > compress_threshold:
+        return True, zlib.compress(data)
+    return False, data
+
+
+def unpack(compressed, data):
+    """Undo pack()"""
+    return zlib.decompress(data) if compressed else data
+
+
+class BlobStore(object):
+    """Presentations stored once per distinct content, and compressed when
+    larger than compress_threshold bytes. put() returns the key to get()
+    the presentation back with, and each put() is undone with release()."""
+
+    compress_threshold = 4096
+
+    def __init__(self, compress_threshold=None):
+        if compress_threshold is not None:
+            self.compress_threshold = compress_threshold
+        self._blobs = dict()  # {key: [references, compressed, data]}
+
+    def put(self, presentation):
+        data = encode(presentation)
+        blob_key = key(data)
+        blob = self._blobs.get(blob_key)
+        if blob is None:
+            blob = self._blobs[blob_key] = \
+                [0] + list(pack(data, self.compress_threshold))
+        blob[0] += 1
+        return blob_key
+
+    def get(self, blob_key):
+        _, compressed, data = self._blobs[blob_key]
+        return decode(unpack(compressed, data))
+
+    def packed(self, blob_key):
+        """Whether the presentation is compressed, and its data, as
+        stored"""
+        _, compressed, data = self._blobs[blob_key]
+        return compressed, data
+
+    def release(self, blob_key):
+        blob = self._blobs[blob_key]
+        blob[0] -= 1
+        if blob[0] == 0:
+            del self._blobs[blob_key]
+
+    def __len__(self):
+        return len(self._blobs)
+
+    @property
+    def size(self):
+        """Bytes of presentation data held"""
+        return sum(len(data) for _, _, data in self._blobs.values())
@@ -1,56 +1,353 @@
 #!/usr/bin/env python3
 
+import bisect
+import hashlib
+import collections
 import urwid
 import resultobject
+import blobstore
+import spill
 
 
-class _CmdHistory(object):
+def digest(entry):
+    """Identifies results that are the same to the history, from the
+    fields of entry, a _StoredResult, and the key of its presentation,
+    rather than the presentation itself"""
+    h = hashlib.blake2b(digest_size=16)
+    for field in (entry.mode_id, entry.command, entry.exec_wd,
+                  entry.status, entry.description):
+        h.update(field.encode(errors='surrogateescape'))
+        h.update(b'\0')
+    h.update(entry.content_key)
+    return h.digest()
+
+
+class _StoredResult(resultobject.ResultObject):
+    """A history entry with its presentation kept in a BlobStore. It is
+    only decompressed when used. Output in a spill.SpillFile stays there,
+    and the file is closed when the entry is released."""
+
+    __slots__ = ('store', 'presentation_key', 'spilled')
+
+    def __init__(self, store):
+        self.store = store
+        self.presentation_key = None
+        self.spilled = None
+        super(_StoredResult, self).__init__()
+
+    @property
+    def presentation(self):
+        if self.spilled is not None:
+            return self.spilled
+        return self.store.get(self.presentation_key)
+
+    @presentation.setter
+    def presentation(self, presentation):
+        if isinstance(presentation, spill.SpillFile):
+            if presentation is not self.spilled:
+                self.release()
+            self.spilled = presentation
+            return
+        key = self.store.put(presentation)
+        self.release()
+        self.presentation_key = key
+        self.spilled = None
+
+    @property
+    def content_key(self):
+        """Identifies the presentation by its content"""
+        if self.spilled is not None:
+            return self.spilled.content_digest().encode()
+        return self.presentation_key
+
+    def release(self):
+        """Give up the presentation. Call when dropped from history"""
+        if self.presentation_key is not None:
+            self.store.release(self.presentation_key)
+            self.presentation_key = None
+        if self.spilled is not None:
+            self.spilled.close()
+            self.spilled = None
+
+
+class _TrigramIndex(object):
+    """Inverted index from the three character substrings of commands to
+    the numbers of the entries containing them, in ascending order. Numbers
+    are added in ascending order, and batches of older entries before
+    them."""
+
     def __init__(self):
-        self.history = list()
-        self.length = 0
-        self.idx = 0
+        self.postings = dict()  # {trigram: [number]}
+
+    @staticmethod
+    def _trigrams(string):
+        return set(string[i:i+3] for i in range(len(string) - 2))
+
+    def add(self, number, command):
+        for trigram in self._trigrams(command):
+            self.postings.setdefault(trigram, list()).append(number)
+
+    def add_older(self, entries):
+        """Add [(number, command)] in ascending order, all numbered before
+        the entries already added"""
+        older = collections.defaultdict(list)
+        for number, command in entries:
+            for trigram in self._trigrams(command):
+                older[trigram].append(number)
+        for trigram, numbers in older.items():
+            numbers.extend(self.postings.get(trigram, ()))
+            self.postings[trigram] = numbers
+
+    def candidates(self, search_str):
+        """Ascending numbers of the entries that may contain search_str, or
+        None if search_str is too short for the index"""
+        trigrams = self._trigrams(search_str)
+        if not trigrams:
+            return None
+        # All the trigrams of search_str are in its entries; use the rarest
+        return min((self.postings.get(trigram, ()) for trigram in trigrams),
+                   key=len)
+
+
+class _CmdHistory(object):
+    """The command history. With a historylog.HistoryLog, the load_size most
+    recent entries are read from it at start, older entries are read when
+    browsing or searching gets to them, and new entries are appended.
+
+    Entries are numbered in the order they were added, and an entry added
+    again is moved to the end. Adding costs the same regardless of the
+    length of the history. Searches of three characters or more go through
+    a _TrigramIndex of the commands."""
+
+    def __init__(self, log=None, load_size=500):
+        self.load_size = load_size
+        self.store = blobstore.BlobStore()  # Presentations of added entries
         self.search_str = ""
+        self.history = dict()  # {number: entry}; moved entries leave gaps
+        self.pending = list()  # Added, not yet stored; see add()
+        self.defer = None  # defer(callback) calls it when idle
+        self.attach(log)
+
+    def attach(self, log):
+        """Read from and append to log from now on. Entries added before
+        are moved after those in the log, and appended to it."""
+        self.flush()
+        added = [self.history[number] for number in sorted(self.history)]
+
+        self.log = log
+        self.history = dict()
+        self.numbers = dict()  # {digest: number}
+        self.index = _TrigramIndex()
+        self.moved = 0  # Numbers in index no longer in history
+        self.logged = 0  # Entries in the log not yet read into history
+        self.missed = None  # A string in none of the entries not yet read
+        if self.log is not None:
+            self.logged = max(0, len(self.log) - self.load_size)
+        self.first = self.end = self.logged  # history numbers in [first, end)
+        if self.log is not None:
+            entries = self.log.read(self.logged, len(self.log))
+            self._insert(entries, self.logged)
+            self.end = self.logged + len(entries)
+        self.length = len(self.history)
+        self.idx = self.end - 1
+
+        for entry in added:
+            self._add(entry)
+            entry.spilled = None  # Now kept by the entry added
+            entry.release()
+
+    def _insert(self, entries, first):
+        """Add the entries read from the log, numbered from first on.
+        Entries already in history, or repeated later on, are dropped, and
+        so are the records that could not be read."""
+        for number in range(first + len(entries) - 1, first - 1, -1):
+            entry = entries[number - first]
+            if entry is None or entry.digest in self.numbers:
+                continue
+            self.numbers[entry.digest] = number
+            self.history[number] = entry
+        self.index.add_older(
+            (number, entries[number - first].command)
+            for number in range(first, first + len(entries))
+            if number in self.history)
 
     def add(self, resultobj):
-        for item in self.history:
-            if vars(resultobj) == vars(item):
-                self.history.remove(item)
+        """Add a copy of resultobj. With defer, storing and compressing
+        it, and appending it to the log, wait until idle rather than delay
+        the key press that made the result. Until then, reading the history
+        brings it up to date first."""
+        entry = resultobject.ResultObject()
+        entry.copy_state(resultobj)
+        self.pending.append(entry)
+        if self.defer is None:
+            self.flush()
+        elif len(self.pending) == 1:
+            self.defer(self.flush)
+
+    def flush(self):
+        """Store the entries added since last time"""
+        pending, self.pending = self.pending, list()
+        for entry in pending:
+            self._add(entry)
 
-        new_item = resultobject.ResultObject()
+    def _add(self, resultobj):
+        new_item = _StoredResult(self.store)
         new_item.copy_state(resultobj)
-        self.history.append(new_item)
+        key = digest(new_item)
+
+        number = self.numbers.pop(key, None)
+        if number is not None:
+            old_item = self.history.pop(number)
+            if isinstance(old_item, _StoredResult):
+                if old_item.spilled is new_item.spilled:
+                    old_item.spilled = None
+                old_item.release()
+            self.moved += 1
+
+        self.numbers[key] = self.end
+        self.history[self.end] = new_item
+        self.index.add(self.end, new_item.command)
+        self.end += 1
+        if self.moved > len(self.history):
+            self._reindex()
         self.length = len(self.history)
-        self.idx = self.length - 1
+        self.idx = self.end - 1
+        if self.log is not None and new_item.status != 'init':
+            blob = None  # Already packed by the store, unless spilled
+            if new_item.presentation_key is not None:
+                blob = (new_item.presentation_key,) + \
+                    self.store.packed(new_item.presentation_key)
+            try:
+                self.log.append(resultobj, key, blob)
+            except OSError:  # E.g. the disk is full
+                self.log = None  # Keep the history in memory only
+                self.logged = 0
+
+    def _reindex(self):
+        self.index = _TrigramIndex()
+        self.index.add_older((number, self.history[number].command)
+                             for number in sorted(self.history))
+        self.moved = 0
+
+    def load_older(self):
+        """Read the next load_size older entries from the log"""
+        self.flush()
+        start = max(0, self.logged - self.load_size)
+        self._insert(self.log.read(start, self.logged), start)
+        self.first = self.logged = start
+        self.length = len(self.history)
+
+    def _search_older(self):
+        """Read older pages of load_size entries from the log until one has
+        an entry containing search_str, and load the pages read. Returns
+        whether one was found. Otherwise nothing is loaded, and the log is
+        not read again for search_str, or strings containing it."""
+        if self.missed is not None and self.missed in self.search_str:
+            return False
+        pages = list()  # [(start, entries)], newest first
+        start = self.logged
+        while start > 0:
+            stop, start = start, max(0, start - self.load_size)
+            entries = self.log.read(start, stop)
+            pages.append((start, entries))
+            if any(entry is not None and self.search_str in entry.command
+                   for entry in entries):
+                for start, entries in pages:
+                    self._insert(entries, start)
+                self.first = self.logged = start
+                self.length = len(self.history)
+                return True
+        self.missed = self.search_str
+        return False
 
     def set_search_str(self, search_str):
-        self.idx = self.length - 1
+        self.flush()
+        self.idx = self.end - 1
         self.search_str = search_str
 
     def get_last_item(self):
+        self.flush()
         if self.length == 0:
             return None
-        return self.history[-1]
+        return self.history[self.end - 1]
 
     def get_curr_idx_item(self):
+        self.flush()
         return self.history[self.idx]
 
-    def get_next_item(self, step, _recur_idx=0):
-        if _recur_idx == self.length:
-            return None
+    def _step(self, number, step):
+        """The number of the next entry in direction step, wrapping around
+        at the ends"""
+        number += step
+        while True:
+            if number < self.first and self.logged:
+                self.load_older()
+                continue
+            if number < self.first:
+                number = self.end - 1
+            elif number >= self.end:
+                number = self.first
+            if number in self.history:
+                return number
+            number += step
 
-        self.idx = max(0, (self.idx + step) % self.length)
-        item = self.history[self.idx]
-        if self.search_str in item.command:
-            return item
-        return self.get_next_item(step, _recur_idx+1)
+    def get_next_item(self, step):
+        self.flush()
+        if self.index.candidates(self.search_str) is not None:
+            return self._search_next_item(step)
+
+        # Not recursive; the history may be long
+        visited = 0
+        while visited < self.length:
+            self.idx = self._step(self.idx, step)
+            item = self.history[self.idx]
+            if self.search_str in item.command:
+                return item
+            visited += 1
+        return None
+
+    def _search_next_item(self, step):
+        """get_next_item() through the index. The candidates are checked,
+        since the trigrams may be in another order in the command, and the
+        entry may have moved."""
+        wrapped = False
+        number = self.idx
+        candidates = self.index.candidates(self.search_str)
+        while True:
+            if step < 0:
+                pos = bisect.bisect_left(candidates, number) - 1
+                found = pos >= 0
+            else:
+                pos = bisect.bisect_right(candidates, number)
+                found = pos < len(candidates)
+
+            if not found:
+                if step < 0 and self.logged and self._search_older():
+                    candidates = self.index.candidates(self.search_str)
+                    continue
+                if wrapped:
+                    return None
+                wrapped = True
+                number = self.end if step < 0 else self.first - 1
+                continue
+
+            number = candidates[pos]
+            item = self.history.get(number)
+            if item is not None and self.search_str in item.command:
+                self.idx = number
+                return item
 
 
 class CmdHistoryWidget(urwid.Edit):
-    def __init__(self, resultobj):
+    def __init__(self, resultobj, log=None, load_size=500):
         self.resultobj = resultobj
-        self.history = _CmdHistory()
+        self.history = _CmdHistory(log, load_size)
         super(CmdHistoryWidget, self).__init__(caption="Search history:")
 
+    def attach(self, log):
+        """See _CmdHistory.attach()"""
+        self.history.attach(log)
+
     def add(self, resultobj):
         self.resultobj.copy_state(resultobj)
         self.history.add(resultobj)
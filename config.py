@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import configparser
+
+
+# Built-in settings. Override in the user's winex.conf, e.g.:
+#
+#   [listing]
+#   cache_size = 256
+#
+#   [aliases]
+#   gs = git status
+#   t =
+#
+# where an empty value removes a built-in alias or color option
+defaults = {'listing': {'cache_size': '64',  # Directories kept in cache
+                        'inotify': 'yes'},
+            'completion': {'cache_size': '256'},  # Directories indexed
+            'history': {'persist': 'yes',
+                        'load_size': '500'},  # Entries read at startup
+            'output': {'spill_threshold': '16777216',  # Bytes in memory
+                       # Beyond the limits, keep the first bytes ('spill'
+                       # and 'head'), or the last ('tail'). Only 'spill'
+                       # moves output beyond spill_threshold to a file
+                       'policy': 'spill',
+                       'max_bytes': '67108864',  # 0 for no limit
+                       'max_lines': '0'},
+            'jobs': {'max_running': '4'},  # More background jobs wait
+            'shell': {'persistent': 'no'},  # One bash for all commands?
+            # Replace the first word of bash commands
+            'aliases': {'ll': 'ls -AhlgF --group-directories-first',
+                        'la': 'ls -Agp --group-directories-first',
+                        'l': 'ls -Fp --group-directories-first',
+                        't': 'tree --dirsfirst -FaL 2',
+                        'g': 'grep',
+                        'kll': 'pkill'},
+            # Options for color, used when the output is not piped
+            'colors': {'ls': '--color=always',
+                       'grep': '--color=always',
+                       'tree': '-C'}}
+
+
+def config_path():
+    config_home = os.environ.get('XDG_CONFIG_HOME') or \
+        os.path.expanduser('~/.config')
+    return os.path.join(config_home, 'winex', 'winex.conf')
+
+
+def data_path():
+    """Where winex keeps its data, e.g. the command history"""
+    data_home = os.environ.get('XDG_DATA_HOME') or \
+        os.path.expanduser('~/.local/share')
+    return os.path.join(data_home, 'winex')
+
+
+# Settings that take one of a few values
+choices = {('output', 'policy'): ('spill', 'head', 'tail')}
+
+problems = list()  # Messages about the settings given bad values
+
+
+def load(path=None):
+    """Read the settings in path on top of the defaults. Missing or
+    unreadable files are silently ignored. Bad values are replaced by the
+    defaults, and reported in problems."""
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str  # Aliases are case sensitive
+    parser.read_dict(defaults)
+    try:
+        parser.read(config_path() if path is None else path)
+    except configparser.Error:
+        pass
+    _check(parser)
+    return parser
+
+
+def _kind(value):
+    """'integer' or 'boolean' for the default value of a setting read as
+    such, otherwise None"""
+    if value.isdigit():
+        return 'integer'
+    if value.lower() in configparser.ConfigParser.BOOLEAN_STATES:
+        return 'boolean'
+    return None
+
+
+def _check(parser):
+    for section, options in defaults.items():
+        for option, default in options.items():
+            kind = _kind(default)
+            value = parser[section][option]
+            if kind == 'integer':
+                bad = not value.strip().isdigit()
+            elif kind == 'boolean':
+                bad = value.lower() not in parser.BOOLEAN_STATES
+            else:
+                continue
+            if bad:
+                problems.append(
+                    f"[{section}] {option}: '{value}' is not "
+                    f"{'a whole number' if kind == 'integer' else 'yes or no'}"
+                    f"; using '{default}'")
+                parser[section][option] = default
+    for (section, option), values in choices.items():
+        value = parser[section][option]
+        if value not in values:
+            default = defaults[section][option]
+            problems.append(
+                f"[{section}] {option}: '{value}' is not one of "
+                f"{', '.join(values)}; using '{default}'")
+            parser[section][option] = default
+
+
+settings = load()
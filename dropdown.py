@@ -3,12 +3,14 @@
 import urwid
 import editor
 import walker
+import fuzzy
 
 
 class DropDown(urwid.Frame):
     """A pop up widget for auto completing user input. The auto complete options
-    are set with the set_content() method, content is filtered with the
-    search() method, and selections are made with 'enter' or 'tab'."""
+    are set with the set_content() method, content is fuzzy matched and
+    ranked with the search() method, and selections are made with 'enter'
+    or 'tab'."""
 
     signals = ['close', 'render']
 
@@ -24,32 +26,86 @@ class DropDown(urwid.Frame):
         self.selection = ''  # The selected option returned to handling widget
         self._selectable = False
 
+        self.content = fuzzy.Candidates()  # The options
+        self._last_search = ('', None)  # (search_str, [(score, idx, pos)])
+
     def set_content(self, content_list):
         """Sets the pop up content_list. The max_width property is also
-        set, and selectable() returns True if content_list is non-empty."""
-        self.walker.set_content(content_list)
+        set, and selectable() returns True if content_list is non-empty.
+        A fuzzy.Candidates content_list is used as is."""
+        if not isinstance(content_list, fuzzy.Candidates):
+            content_list = fuzzy.Candidates(content_list)
+        if content_list is not self.content:
+            self.content = content_list
+            self._last_search = ('', None)
+
+        self.walker.set_content(self.content)
         self._selectable = self.walker.selectable()
         if self._selectable:
             # +1 for the cursor
-            self.max_width = max(map(len, content_list)) + 1
+            self.max_width = max(map(len, self.content)) + 1
         else:
             self.max_width = 1
 
     def search(self, edit_text):
-        """Set edit_text in the pop up editor. Calls Walker.filter_content()
-        with edit_text as argument."""
+        """Set edit_text in the pop up editor, and show the options
+        matching it, best match first."""
         self.editor.edit_text = edit_text
         self.editor.edit_pos = len(edit_text)
-        self.walker.filter_content(edit_text,
-                                   attr_marked='dropdown_marked',
-                                   attr_plain='dropdown_plain')
+        self._show_matches(edit_text)
+
+    def _show_matches(self, search_str):
+        if search_str == '':
+            self.walker.filter_content('')
+            return
+
+        def make_markup(option_positions):
+            return fuzzy.markup(*option_positions,
+                                attr_plain='dropdown_plain',
+                                attr_marked='dropdown_marked')
+
+        self.walker.set_filtered_content(
+            [(self.content[idx], positions)
+             for _, idx, positions in self._find_matches(search_str)],
+            make_markup)
+
+    def _find_matches(self, search_str):
+        """Returns [(score, index, positions)] of the options matching
+        search_str, best match first. When search_str extends the previous
+        search string, only the previous matches are scored again."""
+        last_str, last_matches = self._last_search
+        if last_matches is not None and search_str == last_str:
+            return last_matches
+
+        if last_matches is not None and search_str.startswith(last_str):
+            indices = sorted(idx for _, idx, _ in last_matches)
+        else:
+            indices = range(len(self.content))
+
+        lower = fuzzy.lower(search_str)
+        mask = fuzzy.char_mask(lower)
+        masks = self.content.masks
+        matches = list()
+        for idx in indices:
+            if masks[idx] & mask != mask:  # Cheap rejection
+                continue
+            result = fuzzy.match(lower, self.content[idx],
+                                 self.content.lowered[idx])
+            if result is not None:
+                score, positions = result
+                matches.append((score, idx, positions))
+
+        # Best score first, then shorter options, then in the given order
+        matches.sort(key=lambda m: (-m[0], len(self.content[m[1]]), m[1]))
+        self._last_search = (search_str, matches)
+        return matches
 
     def has_match(self, search_str):
         """Does 'search_str' have a match in the current options list? The empty
         string returns False"""
         if search_str == '':
             return False
-        return self.walker.has_match(search_str)
+        return len(self._find_matches(search_str)) > 0
 
     @property
     def curr_height(self):
@@ -63,9 +119,7 @@ class DropDown(urwid.Frame):
         if len(key) == 1 or key in self.editor._deleters:
             self.set_focus('header')
             super(DropDown, self).keypress(size, key)
-            self.walker.filter_content(self.editor.edit_text,
-                                       attr_marked='dropdown_marked',
-                                       attr_plain='dropdown_plain')
+            self._show_matches(self.editor.edit_text)
 
             # Signal 'close' and return edit_text to calling widget
             if not self.has_match(self.editor.edit_text):
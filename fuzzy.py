@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Scoring in the manner of fzf
+score_match = 16
+score_gap_start = -3
+score_gap_extension = -1
+bonus_boundary = 8  # Match after a separator, or at the start
+bonus_camel = 7  # Upper case after lower case, digit after letter
+bonus_consecutive = 4  # Minimum bonus for continuing a run
+bonus_first_char_multiplier = 2
+
+separators = set(' /\\_-.,:;')
+
+
+def lower(string):
+    """string.lower(), keeping the positions of the characters"""
+    lowered = string.lower()
+    if len(lowered) == len(string):
+        return lowered
+    return ''.join(ch.lower() if len(ch.lower()) == 1 else ch
+                   for ch in string)
+
+
+def char_mask(string):
+    """Bitmask of the (lower case) characters in string. A candidate can
+    only match if its mask covers the mask of the search string."""
+    mask = 0
+    for ch in set(lower(string)):
+        mask |= 1 << (ord(ch) & 63)
+    return mask
+
+
+class Candidates(list):
+    """A list of strings to match against, with their lower() and
+    char_mask() computed up front"""
+
+    def __init__(self, strings=()):
+        super(Candidates, self).__init__(strings)
+        self.lowered = list(map(lower, self))
+        self.masks = list(map(char_mask, self.lowered))
+
+
+def _bonus(candidate, pos):
+    if pos == 0:
+        return bonus_boundary
+    prev, curr = candidate[pos-1], candidate[pos]
+    if prev in separators:
+        return bonus_boundary
+    if (prev.islower() and curr.isupper()) or \
+       (prev.isalpha() and curr.isdigit()):
+        return bonus_camel
+    return 0
+
+
+def match(search_str, candidate, lowered=None):
+    """Scores candidate against the lower case search_str. Every character
+    in search_str must appear in order in candidate, and matches at the
+    start, at word boundaries and in contiguous runs score higher. Returns
+    (score, positions of the matched characters), or None if there is no
+    match. lowered is lower(candidate), if already at hand."""
+    if lowered is None:
+        lowered = lower(candidate)
+
+    # Fast path: search_str is a substring. Score its first occurrence
+    start = lowered.find(search_str)
+    if start != -1:
+        bonus = _bonus(candidate, start)
+        run_bonus = max(bonus, bonus_consecutive)
+        score = len(search_str) * score_match + \
+            bonus * bonus_first_char_multiplier + \
+            (len(search_str) - 1) * run_bonus
+        return score, range(start, start + len(search_str))
+
+    # Find the first occurrence of search_str as a subsequence ...
+    end = -1
+    for ch in search_str:
+        end = lowered.find(ch, end + 1)
+        if end == -1:
+            return None
+
+    # ... and then the shortest one ending in the same place
+    start = end + 1
+    for ch in reversed(search_str):
+        start = lowered.rfind(ch, 0, start)
+
+    score = 0
+    positions = list()
+    run_bonus = 0  # Bonus of the first character in the current run
+    gap = False
+    i = 0
+    for pos in range(start, end + 1):
+        if i < len(search_str) and lowered[pos] == search_str[i]:
+            bonus = _bonus(candidate, pos)
+            if positions and positions[-1] == pos - 1:
+                run_bonus = max(run_bonus, bonus, bonus_consecutive)
+                bonus = run_bonus
+            else:
+                run_bonus = bonus
+            if i == 0:
+                bonus *= bonus_first_char_multiplier
+            score += score_match + bonus
+            positions.append(pos)
+            i += 1
+            gap = False
+        else:
+            score += score_gap_extension if gap else score_gap_start
+            gap = True
+    return score, positions
+
+
+def markup(candidate, positions, attr_plain, attr_marked):
+    """urwid markup of candidate with the characters at positions marked"""
+    markup = list()
+    prev = 0
+    for pos in positions:
+        if pos > prev:
+            markup.append((attr_plain, candidate[prev:pos]))
+        if markup and markup[-1][0] == attr_marked:
+            markup[-1] = (attr_marked, markup[-1][1] + candidate[pos])
+        else:
+            markup.append((attr_marked, candidate[pos]))
+        prev = pos + 1
+    if prev < len(candidate):
+        markup.append((attr_plain, candidate[prev:]))
+    return markup
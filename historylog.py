@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import fcntl
+import struct
+import zlib
+import contextlib
+
+import config
+import resultobject
+import blobstore
+import spill
+
+
+def _encode_presentation(presentation):
+    if isinstance(presentation, spill.SpillFile):  # Too large to keep
+        presentation = f"[{len(presentation)} lines of output not kept]"
+    return blobstore.encode(presentation)
+
+
+class _LoggedResult(resultobject.ResultObject):
+    """A ResultObject read from a HistoryLog. Its presentation is only read
+    from the log when used."""
+
+    __slots__ = ('log', 'blob_offset', '_presentation', 'digest')
+
+    def __init__(self, log, record):
+        super(_LoggedResult, self).__init__()
+        self.log = log
+        self.mode_id = sys.intern(record['mode_id'])
+        self.command = record['command']
+        self.status = sys.intern(record['status'])
+        self.description = record['description']
+        self.exec_wd = record['exec_wd']
+        self.blob_offset = record['blob']
+        self.digest = bytes.fromhex(record['digest'])  # cmdhistory.digest()
+
+    @property
+    def presentation(self):
+        if self.blob_offset is not None:
+            return self.log.read_blob(self.blob_offset)
+        return self._presentation
+
+    @presentation.setter
+    def presentation(self, presentation):
+        self.blob_offset = None
+        self._presentation = presentation
+
+
+class HistoryLog(object):
+    """Command history in append-only files in directory path:
+
+      history.log  One JSON record per line, without the presentation
+      history.idx  The offset of each record in history.log, as uint64
+      history.blb  The presentations, each stored once, as a header with
+                   its key, whether compressed and its size, and the data
+
+    The index lets the most recent records be read without scanning the
+    log, and presentations are only read when shown. Presentations are
+    encoded and compressed like in a blobstore.BlobStore. The offsets of
+    the blobs by key are found by reading the headers, once, when first
+    appending. Raises OSError if the files cannot be opened."""
+
+    offset = struct.Struct('<Q')
+    blob_header = struct.Struct('<16s?Q')  # Key, compressed, size
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self._log = open(os.path.join(path, 'history.log'), 'a+b')
+        self._index = open(os.path.join(path, 'history.idx'), 'a+b')
+        self._blobs = open(os.path.join(path, 'history.blb'), 'a+b')
+        self._blob_offsets = dict()  # {key: offset in history.blb}
+        self._blobs_read = 0  # Headers are read up to this offset
+        with self._locked():
+            self._repair()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Excludes other sessions appending to the same files"""
+        fcntl.flock(self._log, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._log, fcntl.LOCK_UN)
+
+    def _size(self, f):
+        return os.fstat(f.fileno()).st_size
+
+    def _repair(self):
+        """Drop records torn by a crash in the middle of append()"""
+        log_size = self._size(self._log)
+        length = self._size(self._index) // self.offset.size
+        while length > 0:
+            offset = self._offsets(length - 1, length)[0]
+            if offset < log_size:
+                self._log.seek(offset)
+                line = self._log.readline()
+                if line.endswith(b'\n'):
+                    log_size = offset + len(line)
+                    break
+            log_size = min(log_size, offset)
+            length -= 1
+        self._index.truncate(length * self.offset.size)
+        self._log.truncate(log_size if length > 0 else 0)
+
+    def __len__(self):
+        return self._size(self._index) // self.offset.size
+
+    def _offsets(self, start, stop):
+        self._index.seek(start * self.offset.size)
+        data = self._index.read((stop - start) * self.offset.size)
+        return [offset for offset, in self.offset.iter_unpack(data)]
+
+    def _read_blob_headers(self):
+        """Find the blobs appended since last time, by this session or
+        others. A blob torn by a crash is dropped."""
+        size = self._size(self._blobs)
+        offset = self._blobs_read
+        while offset + self.blob_header.size <= size:
+            self._blobs.seek(offset)
+            key, _, length = self.blob_header.unpack(
+                self._blobs.read(self.blob_header.size))
+            end = offset + self.blob_header.size + length
+            if end > size:
+                break
+            self._blob_offsets.setdefault(key, offset)
+            offset = end
+        if offset < size:
+            self._blobs.truncate(offset)
+        self._blobs_read = offset
+
+    def _put_blob(self, presentation, blob=None):
+        """The offset of presentation in history.blb, where it is appended
+        unless there already. blob is (key, compressed, data), presentation
+        as packed by a blobstore.BlobStore, if at hand."""
+        if blob is None:
+            data = _encode_presentation(presentation)
+            blob = (blobstore.key(data),) + blobstore.pack(
+                data, blobstore.BlobStore.compress_threshold)
+        key, compressed, data = blob
+        self._read_blob_headers()
+        offset = self._blob_offsets.get(key)
+        if offset is not None:
+            return offset
+        offset = self._blobs_read
+        self._blobs.write(
+            self.blob_header.pack(key, compressed, len(data)) + data)
+        self._blobs.flush()
+        self._blob_offsets[key] = offset
+        self._blobs_read = self._size(self._blobs)
+        return offset
+
+    def append(self, resultobj, digest, blob=None):
+        """Add resultobj, identified by digest, to the end of the log. See
+        _put_blob() for blob"""
+        with self._locked():
+            blob_offset = self._put_blob(resultobj.presentation, blob)
+            record = {'mode_id': resultobj.mode_id,
+                      'command': resultobj.command,
+                      'status': resultobj.status,
+                      'description': resultobj.description,
+                      'exec_wd': resultobj.exec_wd,
+                      'blob': blob_offset,
+                      'digest': digest.hex()}
+            offset = self._size(self._log)
+            self._log.write(json.dumps(record).encode() + b'\n')
+            self._log.flush()
+            self._index.write(self.offset.pack(offset))
+            self._index.flush()
+
+    def read(self, start, stop):
+        """The records start to stop as ResultObjects, oldest first. Records
+        that cannot be read, e.g. damaged by hand, are None"""
+        if start >= stop:
+            return list()
+        offsets = self._offsets(start, stop + 1)  # Incl. the end of stop
+        end = offsets.pop() if len(offsets) > stop - start else \
+            self._size(self._log)
+        self._log.seek(offsets[0])
+        lines = self._log.read(end - offsets[0]).splitlines()[:stop - start]
+        records = list()
+        for line in lines:
+            try:
+                records.append(_LoggedResult(self, json.loads(line)))
+            except (ValueError, KeyError, TypeError):
+                records.append(None)
+        return records
+
+    def read_blob(self, offset):
+        try:
+            self._blobs.seek(offset)
+            _, compressed, length = self.blob_header.unpack(
+                self._blobs.read(self.blob_header.size))
+            return blobstore.decode(
+                blobstore.unpack(compressed, self._blobs.read(length)))
+        except (OSError, struct.error, zlib.error, ValueError):
+            return "[Output could not be read from the history]"
+
+
+def open_log():
+    """The user's HistoryLog, or None if disabled or unavailable"""
+    if not config.settings.getboolean('history', 'persist'):
+        return None
+    try:
+        return HistoryLog(config.data_path())
+    except OSError:
+        return None
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import urwid
 
 
@@ -54,8 +55,16 @@ class ParentDirectoryWidget(InfoLine):
 
 
 class SessionInfo(InfoLine):
+    """The footer: when the session started, followed by string"""
+
+    def __init__(self, **kwargs):
+        self.started = time.strftime('%H:%M:%S')
+        super(SessionInfo, self).__init__(**kwargs)
+
     def update(self, string=""):
-        self.full_text = f"Session started at ##:##:##"
+        self.full_text = f"Session started at {self.started}"
+        if string:
+            self.full_text += "  |  " + string
         self.full_text_length = len(self.full_text)
         self._invalidate()
 
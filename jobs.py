@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import time
+import collections
+import urwid
+
+import resultobject
+
+
+class Job(object):
+    """A command run in the background. status is 'queued', 'running' or
+    'done', and once done, resultobj holds its outcome."""
+
+    def __init__(self, number, mode_id, command, cmd, exec_wd):
+        self.number = number
+        self.mode_id = mode_id
+        self.command = command  # As typed
+        self.cmd = cmd  # As run
+        self.exec_wd = exec_wd
+        self.status = 'queued'
+        self.started = None
+        self.ended = None
+        self.returncode = None
+        self.resultobj = None
+
+    def finish(self, returncode, stdout='', description=''):
+        self.status = 'done'
+        self.ended = time.time()
+        self.returncode = returncode
+        self.resultobj = resultobject.ResultObject()
+        if returncode == 0:
+            self.resultobj.set_result(
+                self.mode_id, self.command, 'success',
+                description=description, presentation=stdout,
+                exec_wd=self.exec_wd)
+        else:
+            self.resultobj.set_result(
+                self.mode_id, self.command, 'failure',
+                description=description, exec_wd=self.exec_wd)
+
+
+class JobTable(object):
+    """Runs commands in the background with a process.ProcessRunner, at most
+    max_running at a time while the rest wait their turn. on_change(job) is
+    called when a job starts or is done. jobs lists the jobs not done, and
+    the max_done most recently done."""
+
+    max_done = 3
+
+    def __init__(self, runner, max_running=4, on_change=None):
+        self.runner = runner
+        self.max_running = max_running
+        self.on_change = on_change
+        self.jobs = list()
+        self.count = 0  # Jobs started; numbers them
+        self._queue = collections.deque()
+        self._running = 0
+
+    def start(self, mode_id, command, cmd, exec_wd):
+        """Run cmd, typed as command, in directory exec_wd. Returns the
+        Job"""
+        self.count += 1
+        job = Job(self.count, mode_id, command, cmd, exec_wd)
+        self.jobs.append(job)
+        self._queue.append(job)
+        self._run_queued()
+        return job
+
+    def _run_queued(self):
+        while self._queue and self._running < self.max_running:
+            job = self._queue.popleft()
+            job.status = 'running'
+            job.started = time.time()
+            self._running += 1
+            self._changed(job)
+            try:
+                self.runner.run(job.cmd, lambda proc, job=job:
+                                self._done(job, proc), cwd=job.exec_wd)
+            except OSError as err:  # E.g. exec_wd has been removed
+                self._running -= 1
+                job.finish(None, description=str(err))
+                self._changed(job)
+
+    def _done(self, job, proc):
+        self._running -= 1
+        job.finish(proc.returncode, proc.stdout, proc.describe())
+        done = [j for j in self.jobs if j.status == 'done']
+        for old_job in done[:-self.max_done]:
+            self.jobs.remove(old_job)
+        self._changed(job)
+        self._run_queued()
+
+    def _changed(self, job):
+        if self.on_change is not None:
+            self.on_change(job)
+
+    def clear_done(self):
+        """Remove the jobs done from jobs"""
+        self.jobs = [job for job in self.jobs if job.status != 'done']
+
+
+class JobsWidget(urwid.WidgetWrap):
+    """The jobs of a JobTable, one line each with the status or exit code,
+    number and command"""
+
+    def __init__(self, table):
+        self.table = table
+        super(JobsWidget, self).__init__(urwid.Pile([]))
+        self.update()
+
+    def _get_markup(self, job):
+        if job.status == 'done':
+            code = '?' if job.returncode is None else job.returncode
+            status = ('success' if job.returncode == 0 else 'failure',
+                      f" exit {code:<3}")
+            seconds = job.ended - (job.started or job.ended)
+            info = f" [{job.number}] {job.command}  ({seconds:.1f}s)"
+        else:
+            status = ('running' if job.status == 'running' else 'init',
+                      f" {job.status:<8}")
+            info = f" [{job.number}] {job.command}"
+        return [status, info]
+
+    def update(self):
+        options = self._w.options()
+        self._w.contents[:] = [
+            (urwid.Text(self._get_markup(job), wrap='clip'), options)
+            for job in self.table.jobs]
+
+    def __len__(self):
+        return len(self.table.jobs)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+import os
+import grp
+import stat
+import time
+import math
+import ctypes
+import ctypes.util
+import struct
+import locale
+import threading
+import functools
+import collections
+
+import fuzzy
+
+
+# File type to palette attribute, following the default colors of 'ls'
+type_attrs = {stat.S_IFDIR: 'ls_dir',
+              stat.S_IFLNK: 'ls_link',
+              stat.S_IFIFO: 'ls_pipe',
+              stat.S_IFSOCK: 'ls_socket',
+              stat.S_IFBLK: 'ls_device',
+              stat.S_IFCHR: 'ls_device'}
+
+# File type to the indicator appended by 'ls -F'
+type_suffixes = {stat.S_IFDIR: '/',
+                 stat.S_IFIFO: '|',
+                 stat.S_IFSOCK: '='}
+
+six_months = 31556952 // 2  # Older timestamps are shown with year
+
+
+@functools.lru_cache(maxsize=None)
+def _group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return str(gid)
+
+
+def _human_size(size):
+    """Size rounded up like 'ls -h': '873', '4.0K', '121K', '1.5M'"""
+    if size < 1024:
+        return str(size)
+
+    value = float(size)
+    for unit in 'KMGTPEZY':
+        value /= 1024
+        if value < 10:
+            tenths = math.ceil(value * 10)
+            if tenths < 100:
+                return f"{tenths / 10:.1f}{unit}"
+            return f"10{unit}"
+        if math.ceil(value) < 1024:
+            return f"{math.ceil(value)}{unit}"
+    return f"{math.ceil(value)}Y"
+
+
+def _timestamp(mtime, now):
+    if now - six_months < mtime <= now:
+        return time.strftime('%b %e %H:%M', time.localtime(mtime))
+    return time.strftime('%b %e  %Y', time.localtime(mtime))
+
+
+def _name_attr(mode):
+    """Palette attribute for a file name with st_mode mode"""
+    file_type = stat.S_IFMT(mode)
+    if file_type == stat.S_IFDIR:
+        if mode & stat.S_ISVTX and mode & stat.S_IWOTH:
+            return 'ls_sticky_other_writable'
+        if mode & stat.S_IWOTH:
+            return 'ls_other_writable'
+        if mode & stat.S_ISVTX:
+            return 'ls_sticky'
+    elif file_type == stat.S_IFREG:
+        if mode & stat.S_ISUID:
+            return 'ls_setuid'
+        if mode & stat.S_ISGID:
+            return 'ls_setgid'
+        if mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+            return 'ls_exec'
+        return ''
+    return type_attrs.get(file_type, '')
+
+
+def _suffix(mode):
+    file_type = stat.S_IFMT(mode)
+    if file_type == stat.S_IFREG:
+        if mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+            return '*'
+        return ''
+    return type_suffixes.get(file_type, '')
+
+
+def _with_suffix(markup, mode):
+    suffix = _suffix(mode)
+    if suffix:
+        markup.append(('', suffix))
+    return markup
+
+
+def _name_markup(path, name, st):
+    """Markup for the name column, incl. symlink target and type suffix"""
+    if not stat.S_ISLNK(st.st_mode):
+        return _with_suffix([(_name_attr(st.st_mode), name)], st.st_mode)
+
+    markup = [('ls_link', name), ('', ' -> ')]
+    try:
+        target = os.readlink(path)
+    except OSError:
+        return markup
+    try:
+        target_mode = os.stat(path).st_mode
+    except OSError:  # Dangling link
+        return markup + [('', target)]
+    return _with_suffix(markup + [(_name_attr(target_mode), target)],
+                        target_mode)
+
+
+def _sizes(stats):
+    """The size column. Devices show their major and minor numbers"""
+    devices = [(str(os.major(st.st_rdev)), str(os.minor(st.st_rdev)))
+               for st in stats
+               if stat.S_ISBLK(st.st_mode) or stat.S_ISCHR(st.st_mode)]
+    major_width = max((len(major) for major, _ in devices), default=0)
+    minor_width = max((len(minor) for _, minor in devices), default=0)
+
+    sizes = list()
+    devices = iter(devices)
+    for st in stats:
+        if stat.S_ISBLK(st.st_mode) or stat.S_ISCHR(st.st_mode):
+            major, minor = next(devices)
+            sizes.append(f"{major:>{major_width}}, {minor:>{minor_width}}")
+        else:
+            sizes.append(_human_size(st.st_size))
+    return sizes
+
+
+def list_directory(path='.'):
+    """The contents of directory path as urwid markup, one item per line, in
+    the format of 'ls -AhlgF --group-directories-first --color=always'."""
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError as err:
+        return [f"cannot open directory '{path}': {err.strerror}"]
+
+    # (is_dir, sort_key, name, lstat result)
+    rows = list()
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+            is_dir = entry.is_dir()  # Links to directories are grouped too
+        except OSError:  # Removed since scandir()
+            continue
+        rows.append((not is_dir, locale.strxfrm(entry.name), entry.name, st))
+    rows.sort(key=lambda row: row[:2])
+
+    now = time.time()
+    nlinks = [str(st.st_nlink) for _, _, _, st in rows]
+    groups = [_group_name(st.st_gid) for _, _, _, st in rows]
+    sizes = _sizes([st for _, _, _, st in rows])
+    nlink_width = max(map(len, nlinks), default=0)
+    group_width = max(map(len, groups), default=0)
+    size_width = max(map(len, sizes), default=0)
+
+    total = sum(st.st_blocks for _, _, _, st in rows) * 512
+    markup_list = [f"total {_human_size(total)}"]
+    for (_, _, name, st), nlink, group, size in zip(rows, nlinks, groups,
+                                                    sizes):
+        columns = (f"{stat.filemode(st.st_mode)} "
+                   f"{nlink:>{nlink_width}} "
+                   f"{group:<{group_width}} "
+                   f"{size:>{size_width}} "
+                   f"{_timestamp(st.st_mtime, now)} ")
+        name_markup = _name_markup(os.path.join(path, name), name, st)
+        markup_list.append([('', columns)] + name_markup)
+    return markup_list
+
+
+class _Inotify(object):
+    """Minimal ctypes binding to the Linux inotify API. Raises OSError where
+    it is unavailable."""
+
+    # IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    # IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    mask = 0x002 | 0x004 | 0x040 | 0x080 | 0x100 | 0x200 | 0x400 | 0x800
+    event = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify not supported")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch", path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Watch descriptors with pending events. -1 means the event queue
+        overflowed and events were lost."""
+        wds = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return wds
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = self.event.unpack_from(data, offset)
+                wds.add(wd)
+                offset += self.event.size + length
+
+
+class ListingCache(object):
+    """Directory listings keyed by real path. A listing is reused until the
+    directory's mtime changes, or, where inotify is available, until
+    anything in the directory changes. Without inotify, changes to the size
+    or mtime of existing files are not seen until an entry is added to,
+    removed from or renamed in the directory. The least recently used
+    listings are evicted beyond max_size."""
+
+    def __init__(self, max_size=64, use_inotify=True):
+        self.max_size = max_size
+        # {real path: [st_mtime_ns, markup_list, watch descriptor or None]}
+        self._listings = collections.OrderedDict()
+        self._paths = dict()  # {watch descriptor: real path}
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except OSError:
+                pass
+
+    def get(self, path='.'):
+        """The listing of path, as returned by list_directory()"""
+        real_path = os.path.realpath(path)
+        try:
+            mtime = os.stat(real_path).st_mtime_ns
+        except OSError:
+            return list_directory(path)
+
+        self._invalidate_changed()
+        entry = self._listings.get(real_path)
+        if entry is not None and entry[0] == mtime:
+            self._listings.move_to_end(real_path)
+            return entry[1]
+
+        if entry is not None:
+            self._evict(real_path)
+        markup_list = list_directory(path)
+        wd = None
+        if self._inotify is not None:
+            try:
+                wd = self._inotify.add_watch(real_path)
+                self._paths[wd] = real_path
+            except OSError:  # E.g. out of watches. Fall back to mtime
+                pass
+        self._listings[real_path] = [mtime, markup_list, wd]
+
+        while len(self._listings) > self.max_size:
+            self._evict(next(iter(self._listings)))
+        return markup_list
+
+    def _invalidate_changed(self):
+        if self._inotify is None:
+            return
+        wds = self._inotify.read_events()
+        if -1 in wds:  # Queue overflow
+            wds = list(self._paths.keys())
+        for wd in wds:
+            if wd in self._paths:
+                self._evict(self._paths[wd])
+
+    def _evict(self, real_path):
+        _, _, wd = self._listings.pop(real_path)
+        if wd is not None:
+            del self._paths[wd]
+            self._inotify.rm_watch(wd)
+
+
+def _completion_names(path):
+    """The names in directory path, directories first and with a trailing
+    '/', as fuzzy.Candidates. Unreadable directories have no names."""
+    dirs = list()
+    files = list()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry.name + '/')
+                else:
+                    files.append(entry.name)
+    except OSError:
+        pass
+    return fuzzy.Candidates(dirs + files)
+
+
+class CompletionIndex(object):
+    """Directory contents for auto completion, keyed by absolute path and
+    reused until the directory's mtime changes. prefetch() indexes a
+    directory and its subdirectories in a background thread, so that
+    completing in them does not have to wait for the file system. The least
+    recently used indexes are evicted beyond max_size."""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._indexes = collections.OrderedDict()  # {path: (mtime, names)}
+        self._prefetching = set()  # Paths being prefetched
+        self._lock = threading.Lock()  # Guards the above
+
+    def get(self, path):
+        """The names in directory path, as returned by _completion_names().
+        The returned list is shared and must not be modified."""
+        path = os.path.abspath(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return fuzzy.Candidates()
+
+        with self._lock:
+            entry = self._indexes.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._indexes.move_to_end(path)
+                return entry[1]
+
+        names = _completion_names(path)
+        with self._lock:
+            self._indexes[path] = (mtime, names)
+            self._indexes.move_to_end(path)
+            while len(self._indexes) > self.max_size:
+                self._indexes.popitem(last=False)
+        return names
+
+    def prefetch(self, path):
+        """Index path and its immediate subdirectories in the background"""
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._prefetching:
+                return
+            self._prefetching.add(path)
+        threading.Thread(target=self._prefetch, args=(path,),
+                         daemon=True).start()
+
+    def _prefetch(self, path):
+        try:
+            subdirs = [name[:-1] for name in self.get(path)
+                       if name.endswith('/')]
+            # Leave room for path itself
+            for name in subdirs[:self.max_size - 1]:
+                self.get(os.path.join(path, name))
+            self.get(path)  # Most recently used
+        finally:
+            with self._lock:
+                self._prefetching.discard(path)
+
+
+if __name__ == '__main__':
+    import sys
+    import urwid
+
+    for markup in list_directory(*sys.argv[1:]):
+        print(urwid.util.decompose_tagmarkup(markup)[0])
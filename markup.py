@@ -1,64 +1,64 @@
 import urwid
 import re
+import threading
+import collections
+import collections.abc
+
+import spans
 
 
 class ColorMapper(object):
     """Handles the mapping of bash color codes to urwid text markup."""
 
-    # Pattern for returning full bash color code
-    # incl. escape character, etc: '[01;34m'
-    fullpattern = re.compile(
-        r'(\[(?:\d{1,3};)*(?:\d{1,3}m(?:\[K)?))', flags=re.UNICODE)
-    # Pattern for returning only bash color codes separated by ';': '01;34'
-    filtpattern = re.compile(
-        r'(?:\[)((?:\d{1,3};)*(?:\d{1,3}))(?:m(?:\[K)?)', flags=re.UNICODE)
-
-    # Mapping for str.replace of 'alternative' bash color codes for 'default'
-    replace_alt1 = ('[m[K', '[0m')
-
-    # Foreground bash to urwid color mapping
-    foreground_codes = {'0': 'default',
-                        '30': 'black',
-                        '31': 'dark red',
-                        '32': 'dark green',
-                        '34': 'dark blue',
-                        '35': 'dark magenta',
-                        '36': 'dark cyan',
-                        '37': 'light gray',
-                        '90': 'dark gray',
-                        '91': 'light red',
-                        '92': 'light green',
-                        '93': 'yellow',
-                        '94': 'light blue',
-                        '95': 'light magenta',
-                        '96': 'light cyan',
-                        '97': 'white',
-                        '01': 'bold',
-                        '04': 'underline',
-                        '07': 'standout',
-                        '05': 'blink'}
-
-    # Background bash to urwid color mapping
-    background_codes = {'40': 'black',
-                        '41': 'dark red',
-                        '42': 'dark green',
-                        '44': 'dark blue',
-                        '45': 'dark magenta',
-                        '46': 'dark cyan',
-                        '47': 'light gray'}
+    # Control Sequence Introducer: '\x1b[01;34m' gives ('01;34', 'm'). Only
+    # SGR ('m') sequences change the colors; others, like '\x1b[K', are
+    # dropped from the text
+    csi_pattern = re.compile('\x1b\\[([0-9;:]*)([@-~])')
+    # Runs of consecutive sequences, like '\x1b[01;31m\x1b[K'
+    csi_run_pattern = re.compile(
+        '(\x1b\\[[0-9;:]*[@-~](?:\x1b\\[[0-9;:]*[@-~])*)')
+
+    # urwid names of the 16 basic colors, in SGR order: 30-37 and 90-97
+    basic_colors = ['black', 'dark red', 'dark green', 'brown',
+                    'dark blue', 'dark magenta', 'dark cyan', 'light gray',
+                    'dark gray', 'light red', 'light green', 'yellow',
+                    'light blue', 'light magenta', 'light cyan', 'white']
+
+    # Text settings: SGR code, urwid name, and the SGR code turning it off.
+    # Each setting is a bit in the state's flags
+    settings = [(1, 'bold', 22),
+                (3, 'italics', 23),
+                (4, 'underline', 24),
+                (5, 'blink', 25),
+                (7, 'standout', 27),
+                (9, 'strikethrough', 29)]
+    setting_on = {code: 1 << i for i, (code, _, _) in enumerate(settings)}
+    setting_off = {code: 1 << i for i, (_, _, code) in enumerate(settings)}
+
+    # Levels of the 6x6x6 color cube in the 256 color palette
+    cube_levels = (0, 95, 135, 175, 215, 255)
+
+    # The state is (foreground, background, flags), where colors are 256
+    # color palette indices or None for the terminal's default
+    default_state = (None, None, 0)
+
+    max_transitions = 4096  # Transitions remembered, least recent dropped
 
     def __init__(self):
         """Serves only for instance initialization.
         Call setup with the MainLoop instance
         after initialization."""
         self.register_palette_entry = None  # See setup()
-        self.attr_names = list()
+        self.attr_names = {self.default_state: ''}  # {state: attr_name}
+        # {(state, run of control sequences): (next state, attr_name)}
+        self.transitions = collections.OrderedDict()
 
     def setup(self, mainloop):
         """Point register_palette_entry to
         MainLoop.screen.register_palette_entry()"""
         self.register_palette_entry = mainloop.screen.register_palette_entry
 
+    @spans.traced('get_markup')
     def get_markup(self, string):
         """
         Searches string for bash color codes and returns urwid-type markup.
@@ -66,51 +66,288 @@ class ColorMapper(object):
         to MainLoop's palette.
 
         Example:
-        >>> markup('Hello [01;34mworld![0m')
-        [('', Hello '), ('01;34', 'world!'), ('0', '')]
+        >>> markup('Hello \x1b[01;34mworld!\x1b[0m')
+        [('', 'Hello '), ('1;34', 'world!')]
         """
 
         # Does string have bash color codes?
-        if not self.fullpattern.search(string):
+        if '\x1b' not in string:
             return string
+        return self._parse(string, self.default_state)[0]
+
+    @spans.traced('get_markup_many')
+    def get_markup_many(self, text):
+        """
+        Returns a list of urwid-type markup, one per line in text. Colors
+        still active at the end of a line carry over to the next.
 
-        string = string.replace(*self.replace_alt1)
+        Example:
+        >>> markup_many('Hello \x1b[01;34mworld\n!\x1b[0m')
+        [[('', 'Hello '), ('1;34', 'world')], [('1;34', '!')]]
+        """
+
+        # Lines end with '\n' only, like command output; see process.py
+        lines = text.split('\n')
+        if not lines[-1]:
+            lines.pop()
+
+        # Does text have bash color codes?
+        if '\x1b' not in text:
+            return lines
+        return self.get_markup_lines(lines)[0]
+
+    def get_markup_lines(self, lines, state=None):
+        """Like get_markup_many(), for a list of lines and starting in state.
+        Returns the list of markup and the state at the end of the last line,
+        which can be passed on with the lines that follow. state=None starts
+        with the terminal's default colors."""
+        if state is None:
+            state = self.default_state
+
+        markup_list = list()
+        for line in lines:
+            if '\x1b' in line:
+                markup, state = self._parse(line, state)
+                markup_list.append(markup)
+            elif state == self.default_state or not line:
+                markup_list.append(line)
+            else:
+                markup_list.append([(self.attr_names[state], line)])
+        return markup_list, state
+
+    def _parse(self, string, state):
+        """Single pass over string, starting in state. Returns the markup
+        and the state at the end of string."""
         markup = list()
-        attr_name = ''
+        attr_name = self._attr_name(state)
+        transitions = self.transitions
 
         # Pattern.split() gives a list like
-        # ['Hello ', '[01;34m', 'world!', '[0m']
-        for element in self.fullpattern.split(string):
-            match = self.filtpattern.fullmatch(element)
-
-            # element is color code
-            if match:
-                attr_name = match.group(1)  # attr_name on the form of '01;34'
-
-                if attr_name in self.attr_names:
-                    continue
-                self.attr_names.append(attr_name)
-
-                codes = attr_name.split(';')
-                attr_foreground = list()
-                attr_background = list()
-                for code in codes:
-                    if code in self.foreground_codes:
-                        attr_foreground.append(self.foreground_codes[code])
-                    elif code in self.background_codes:
-                        attr_background.append(self.background_codes[code])
-                    # else: disregard code and use default
-
-                # Register new attribute in MainLoop's palette
-                self.register_palette_entry(attr_name,
-                                            ','.join(attr_foreground),
-                                            ','.join(attr_background))
-
-            # element is text and non-empty
-            elif element:
-                markup.append((attr_name, element))
-
-        return markup
+        # ['Hello ', '\x1b[01;34m', 'world!', '\x1b[0m\x1b[K', '']
+        parts = self.csi_run_pattern.split(string)
+        if parts[0]:
+            markup.append((attr_name, parts[0]))
+        for run, text in zip(parts[1::2], parts[2::2]):
+            key = (state, run)
+            try:
+                state, attr_name = transitions[key]
+                transitions.move_to_end(key)
+            except KeyError:
+                state, attr_name = transitions[key] = \
+                    self._transition(state, run)
+                if len(transitions) > self.max_transitions:
+                    transitions.popitem(last=False)
+            if text:
+                markup.append((attr_name, text))
+        return markup, state
+
+    def _attr_name(self, state):
+        """The attribute name of state, registered when first used"""
+        attr_name = self.attr_names.get(state)
+        if attr_name is None:
+            attr_name = self._register(state)
+        return attr_name
+
+    def _transition(self, state, run):
+        """The state after the run of control sequences, and its attribute
+        name"""
+        for params, final in self.csi_pattern.findall(run):
+            if final == 'm':
+                state = self._apply_sgr(state, params)
+        return state, self._attr_name(state)
+
+    def _apply_sgr(self, state, params):
+        """The state after the SGR sequence with parameters params"""
+        fg, bg, flags = state
+        # Parameters are separated by ';'. A parameter may have
+        # sub-parameters separated by ':', as in '38:2::255:0:0', kept as a
+        # tuple where empty ones are None
+        codes = list()
+        for param in params.split(';'):
+            if ':' in param:
+                codes.append(tuple(int(sub) if sub else None
+                                   for sub in param.split(':')))
+            else:
+                codes.append(int(param) if param else 0)
+
+        i = 0
+        while i < len(codes):
+            code = codes[i]
+            subs = None
+            if isinstance(code, tuple):
+                code, subs = code[0] or 0, code[1:]
+            if code == 0:
+                fg, bg, flags = self.default_state
+            elif code in self.setting_on:
+                flags |= self.setting_on[code]
+            elif code in self.setting_off:
+                flags &= ~self.setting_off[code]
+            elif 30 <= code <= 37:
+                fg = code - 30
+            elif 90 <= code <= 97:
+                fg = code - 90 + 8
+            elif code == 39:
+                fg = None
+            elif 40 <= code <= 47:
+                bg = code - 40
+            elif 100 <= code <= 107:
+                bg = code - 100 + 8
+            elif code == 49:
+                bg = None
+            elif code in (38, 48):
+                if subs is None:
+                    color, i = self._extended_color(codes, i)
+                else:
+                    color = self._colon_color(subs)
+                if code == 38:
+                    fg = color
+                else:
+                    bg = color
+            # else: disregard code
+            i += 1
+        return (fg, bg, flags)
+
+    def _extended_color(self, codes, i):
+        """Parses '38;5;n' and '38;2;r;g;b' starting at codes[i]. Returns the
+        256 color palette index and the position of the last code used.
+        Sub-parameters among the codes, as in '38;5;1:2', are malformed."""
+        if codes[i+1:i+2] == [5] and len(codes) > i+2 and \
+                isinstance(codes[i+2], int):
+            return min(codes[i+2], 255), i+2
+        if codes[i+1:i+2] == [2] and len(codes) > i+4 and \
+                all(isinstance(code, int) for code in codes[i+2:i+5]):
+            return self._nearest_color(*codes[i+2:i+5]), i+4
+        return None, len(codes)  # Malformed; disregard the rest
+
+    def _colon_color(self, subs):
+        """Parses the sub-parameters after 38 or 48 in '38:5:n', and in
+        '38:2:r:g:b' with or without the color space id, as in
+        '38:2::r:g:b'. Returns the 256 color palette index, or None if
+        malformed."""
+        if subs[:1] == (5,) and len(subs) > 1 and subs[1] is not None:
+            return min(subs[1], 255)
+        if subs[:1] == (2,) and len(subs) > 3:
+            rgb = subs[2:5] if len(subs) > 4 else subs[1:4]
+            return self._nearest_color(*(value or 0 for value in rgb))
+        return None
+
+    def _nearest_color(self, r, g, b):
+        """256 color palette index nearest to 24 bit color r, g, b"""
+        def nearest_level(value):
+            return min(range(6), key=lambda i: abs(self.cube_levels[i]-value))
+
+        r6, g6, b6 = map(nearest_level, (r, g, b))
+        cube = (self.cube_levels[r6], self.cube_levels[g6],
+                self.cube_levels[b6])
+        gray_step = min(23, max(0, round(((r + g + b) / 3 - 8) / 10)))
+        gray = 8 + 10 * gray_step
+
+        def distance(color):
+            return sum((x - y)**2 for x, y in zip(color, (r, g, b)))
+        if distance((gray,)*3) < distance(cube):
+            return 232 + gray_step
+        return 16 + 36*r6 + 6*g6 + b6
+
+    def _register(self, state):
+        """Register state as new attribute in MainLoop's palette. The
+        attribute name is the canonical SGR parameter string: '1;34'"""
+        fg, bg, flags = state
+        codes = list()
+        names = list()
+        for i, (code, name, _) in enumerate(self.settings):
+            if flags & (1 << i):
+                codes.append(str(code))
+                names.append(name)
+        for color, base in ((fg, 30), (bg, 40)):
+            if color is None:
+                continue
+            if color < 8:
+                codes.append(str(base + color))
+            elif color < 16:
+                codes.append(str(base + 60 + color - 8))
+            else:
+                codes.append(f'{base + 8};5;{color}')
+        attr_name = ';'.join(codes)
+
+        def low(color):  # 16 color terminals
+            if color is None or color >= 16:
+                return ''
+            return self.basic_colors[color]
+
+        def high(color):  # 88 and 256 color terminals
+            if color is None or color < 16:
+                return low(color)
+            return f'h{color}'
+
+        def join(color, names):
+            return ','.join(filter(None, [color] + names))
+
+        self.register_palette_entry(attr_name, join(low(fg), names), low(bg),
+                                    foreground_high=join(high(fg), names),
+                                    background_high=high(bg))
+        self.attr_names[state] = attr_name
+        return attr_name
+
+
+class MarkupLines(collections.abc.Sequence):
+    """The markup of lines, a sequence of text that may grow, like a
+    spill.SpillFile, made as they are asked for. Colors still active at the
+    end of a line carry over to the next, as in get_markup_many(). The
+    state at the start of every step-th line is kept, so no more than step
+    lines are parsed to find the state of a line, and so is the state
+    after the line last asked for, so reading in order parses each line
+    once."""
+
+    step = 256
+
+    def __init__(self, color_mapper, lines):
+        self.color_mapper = color_mapper
+        self.lines = lines
+        self._states = [color_mapper.default_state]  # Every step-th line
+        self._last = (0, color_mapper.default_state)  # (position, state)
+        self._lock = threading.Lock()  # Lines may be read by other threads
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, position):
+        length = len(self)
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError(position)
+        with self._lock:
+            state = self._state(position, length)
+            markup_list, state = self.color_mapper.get_markup_lines(
+                [self.lines[position]], state)
+            if position + 1 < length:  # Not the last line, which may grow
+                self._last = (position + 1, state)
+        return markup_list[0]
+
+    def _state(self, position, length):
+        """The state at the start of the line at position. Only states
+        after complete lines are kept; the last line may still grow"""
+        states = self._states
+        while len(states) <= position // self.step and \
+                len(states) * self.step < length:
+            start = (len(states) - 1) * self.step
+            states.append(self._advance(states[-1], start, start + self.step))
+        checkpoint = min(position // self.step, len(states) - 1)
+        start, state = checkpoint * self.step, states[checkpoint]
+        last_position, last_state = self._last
+        if start <= last_position <= position:
+            start, state = last_position, last_state
+        state = self._advance(state, start, position)
+        self._last = (position, state)
+        return state
+
+    def _advance(self, state, start, end):
+        """The state after the lines from start to end"""
+        for position in range(start, end):
+            line = self.lines[position]
+            if '\x1b' in line:
+                state = self.color_mapper.get_markup_lines([line], state)[1]
+        return state
 
 
 class DynColorEdit(urwid.Edit):
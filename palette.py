@@ -11,11 +11,23 @@ palette = [('directory', 'dark blue, bold', ''),
            ('success', 'black', 'dark green'),
            ('failure', 'black', 'dark red'),
            ('error', 'black', 'dark red'),
+           ('running', 'black', 'dark cyan'),
            ('prompt', 'black', 'yellow'),
            ('dropdown_editor', 'white', 'dark gray'),
            ('dropdown_plain', 'white', 'dark green'),
            ('dropdown_marked', 'dark red, bold', 'dark green'),
-           ('dropdown_walk', 'black', 'light green')]
+           ('dropdown_walk', 'black', 'light green'),
+           ('ls_dir', 'dark blue, bold', ''),
+           ('ls_link', 'dark cyan, bold', ''),
+           ('ls_exec', 'dark green, bold', ''),
+           ('ls_pipe', 'brown', ''),
+           ('ls_socket', 'dark magenta, bold', ''),
+           ('ls_device', 'yellow', 'black'),
+           ('ls_setuid', 'light gray', 'dark red'),
+           ('ls_setgid', 'black', 'brown'),
+           ('ls_sticky', 'light gray', 'dark blue'),
+           ('ls_other_writable', 'dark blue', 'dark green'),
+           ('ls_sticky_other_writable', 'black', 'dark green')]
 
 
 if __name__ == '__main__':
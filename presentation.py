@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import os
 import urwid
 import walker
+import markup
+import spill
 
 
 def init_widget():
@@ -16,23 +19,132 @@ def init_widget():
 
 
 class PresentationWidget(walker.Walker):
-    def __init__(self, get_markup):
-        self.get_markup = get_markup  # A function object
+    """Shows the presentation of a result. search() finds text in it in the
+    background and emits 'search' as it progresses, once setup() has been
+    called with the MainLoop."""
+
+    signals = ['search']
+
+    def __init__(self, color_mapper):
+        self.color_mapper = color_mapper
+        self.markup_state = None  # Colors at the end of appended output
+        self.search_pattern = ''
+        self._search_origin = None  # Where to look for the first match
+        self._notify_fd = None  # See setup()
         super(PresentationWidget, self).__init__()
         self._selectable = False
         self.update()
 
+    def setup(self, mainloop):
+        """Search in a background thread reporting to mainloop"""
+        self._notify_fd = mainloop.watch_pipe(self._search_progress)
+
+    def search(self, search_pattern):
+        """Find search_pattern, and focus its first match from the focus
+        position on as soon as it is found. '' ends the search."""
+        self.search_pattern = search_pattern
+        if search_pattern == '':
+            self.cancel_search()
+            self._emit('search')
+            return
+
+        self._search_origin = self.focus_position if self.focus else 0
+        notify = None
+        if self._notify_fd is not None:
+            notify = lambda: os.write(self._notify_fd, b'.')
+        super(PresentationWidget, self).search(search_pattern, notify)
+        if notify is None:
+            self._search_progress()
+
+    def _search_progress(self, data=b''):
+        # From the first match at the origin on, or after wrapping around
+        if self._search_origin is not None and self.search_matches:
+            matches = self.search_matches
+            if matches[-1] >= self._search_origin or self.search_done:
+                self.next_match(+1, self._search_origin - 1)
+                self._search_origin = None
+        self._emit('search')
+
+    def plain_text(self, item):
+        if isinstance(item, str):
+            if '\x1b' in item:  # Remove color codes
+                return self.color_mapper.csi_pattern.sub('', item)
+            return item
+        return super(PresentationWidget, self).plain_text(item)
+
     def update(self, presentation="", force=False):
         if not (presentation or force):
             return
 
-        presentation = presentation.splitlines()
-        markup_list = list()
-        for line in presentation:
-            markup_list.append(self.get_markup(line))
-        self.set_content(markup_list)
+        self.markup_state = None
+
+        # Lines of text, colored as they are shown. Colors carry over from
+        # line to line, except in a ring buffer, which loses lines at the
+        # start
+        if isinstance(presentation, spill.SpillFile):
+            self.set_content(
+                markup.MarkupLines(self.color_mapper, presentation))
+            return
+        if isinstance(presentation, spill.RingBuffer):
+            self.set_content(presentation,
+                             make_markup=self.color_mapper.get_markup)
+            return
+
+        # Already urwid markup, one item per line
+        if not isinstance(presentation, str):
+            self.set_content(presentation)
+            return
+
+        self.set_content(self.color_mapper.get_markup_many(presentation))
+
+    def append(self, lines):
+        """Add lines of output to the presentation as they arrive. Output
+        moved to a spill.SpillFile, or kept in a spill.RingBuffer, is shown
+        from there as it changes."""
+        if isinstance(lines, (spill.SpillFile, spill.RingBuffer)):
+            contents = self.original_body.contents
+            if contents is lines or getattr(contents, 'lines', None) is lines:
+                self.refresh()
+            else:
+                self.update(lines, force=True)
+            return
+
+        markup_list, self.markup_state = self.color_mapper.get_markup_lines(
+            lines, self.markup_state)
+        self.append_content(markup_list)
 
     def reset_widget(self):
         if self.focus is None:
             return
         self.focus_position = 0
+
+
+class SearchWidget(urwid.Edit):
+    """Footer for searching the presentation while typing, like '/' in
+    less. Shows the number of matches found so far."""
+
+    def __init__(self, presentation):
+        self.presentation = presentation
+        super(SearchWidget, self).__init__(caption="/")
+        urwid.connect_signal(presentation, 'search',
+                             lambda x: self.show_status())
+
+    def show_status(self):
+        if self.presentation.search_pattern == '':
+            self.set_caption("/")
+            return
+        count = len(self.presentation.search_matches)
+        more = '' if self.presentation.search_done else '+'
+        self.set_caption(f"({count}{more} matches) /")
+
+    def reset_widget(self):
+        """End the search"""
+        self.set_edit_text("")
+        self.presentation.search("")
+
+    def keypress(self, size, key):
+        super(SearchWidget, self).keypress(size, key)
+        if len(key) == 1 or key == 'backspace':
+            self.presentation.search(self.edit_text)
+        return key
+
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import shlex
+import codecs
+import locale
+import secrets
+import subprocess
+import collections
+
+import spill
+import spans
+
+
+# What to keep of output beyond max_bytes or max_lines (0 for no limit):
+# 'head' keeps the start, 'tail' the end, in a spill.RingBuffer, and 'spill'
+# keeps the start like 'head', with what is beyond spill_threshold in a file
+Limits = collections.namedtuple('Limits', 'policy max_bytes max_lines',
+                                defaults=('spill', 0, 0))
+
+
+class _Process(object):
+    """A shell command running on the urwid event loop. stdout and stderr are
+    read as data becomes available. Complete stdout lines are passed to
+    on_output(process, lines) as they arrive, and on_exit(process) is called
+    when the command has finished.
+
+    stdout beyond spill_threshold bytes is moved to a spill.SpillFile,
+    process.spill, to save memory. From then on the SpillFile is passed to
+    on_output in place of lines as it grows, and becomes process.stdout.
+
+    Output beyond limits, a Limits, is not kept, and a marker line tells how
+    many bytes were dropped. With the 'tail' policy, the last lines are kept
+    in a spill.RingBuffer, process.tail, passed to on_output like a
+    SpillFile."""
+
+    poll_interval = 0.05  # Seconds between polls for exit after pipes close
+    line_break = re.compile('\r\n|\r|\n')  # For streamed and final output
+    marker = "[... {:,} bytes not kept ...]"
+
+    def __init__(self, event_loop, cmd, on_exit, on_output=None,
+                 spill_threshold=None, cwd=None, limits=None):
+        self.event_loop = event_loop
+        self.cmd = cmd
+        self.on_exit = on_exit
+        self.on_output = on_output
+        self.spill_threshold = spill_threshold
+        self.limits = limits or Limits()
+        self.spill = None
+        self.tail = None
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.exit_wd = None  # The shell's directory at exit, where known
+        self.stdout_size = 0  # Bytes, kept or not
+        self._kept_size = 0  # Bytes of stdout kept, unless in tail
+        self._kept_lines = 0
+        self._stderr_size = 0
+        self._partial_line = ''  # stdout read after the last line break
+        self._started = spans.now()
+        self.encoding = locale.getpreferredencoding(False)
+        self._pipes = dict()  # {fd: [pipe, decoder, chunks read, watch]}
+        self._start(cwd)
+
+    def _add_pipe(self, fd, pipe=None):
+        decoder = codecs.getincrementaldecoder(self.encoding)(
+            errors='replace')
+        self._pipes[fd] = [pipe, decoder, list(), None]
+
+    def _start(self, cwd):
+        """Start cmd, and watch its output"""
+        self.popen = subprocess.Popen(
+            self.cmd, shell=True, cwd=cwd, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stdout_fd = self.popen.stdout.fileno()
+        self._stderr_fd = self.popen.stderr.fileno()
+        for pipe in (self.popen.stdout, self.popen.stderr):
+            self._add_pipe(pipe.fileno(), pipe)
+
+        if self.event_loop is None:
+            self._communicate()
+            return
+
+        for fd, entry in self._pipes.items():
+            os.set_blocking(fd, False)
+            entry[3] = self.event_loop.watch_file(
+                fd, lambda fd=fd: self._read(fd))
+
+    def _communicate(self):
+        """Blocking fallback when no event loop is available."""
+        out, err = self.popen.communicate()
+        for fd, data in ((self._stdout_fd, out), (self._stderr_fd, err)):
+            if data:
+                self._receive(fd, data)
+            self._end_stream(fd)
+        self._finish()
+
+    def _read(self, fd):
+        pipe, _, _, handle = self._pipes[fd]
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+
+        if data:
+            self._receive(fd, data)
+            return
+
+        # EOF
+        self._end_stream(fd)
+        self.event_loop.remove_watch_file(handle)
+        pipe.close()
+        self._pipes[fd][3] = None
+        if all(entry[3] is None for entry in self._pipes.values()):
+            self._poll()
+
+    def _receive(self, fd, data):
+        """Take in data read from fd"""
+        _, decoder, chunks, _ = self._pipes[fd]
+        if fd != self._stdout_fd:
+            max_bytes = self.limits.max_bytes
+            if not max_bytes or self._stderr_size < max_bytes:
+                chunks.append(data[:max_bytes - self._stderr_size]
+                              if max_bytes else data)
+            self._stderr_size += len(data)
+            return
+
+        self.stdout_size += len(data)
+        if self.tail is not None:
+            self._keep_tail(data)
+            return
+        kept = self._cap(data)
+        if len(kept) < len(data) and self.limits.policy == 'tail':
+            self._keep_tail(b''.join(chunks) + data)
+            chunks.clear()
+        elif not kept:
+            return
+        elif self.spill is not None:
+            self._spill(kept)
+        else:
+            chunks.append(kept)
+            if self.spill_threshold is not None and \
+               self.limits.policy == 'spill' and \
+               self._kept_size > self.spill_threshold:
+                self._spill(b''.join(chunks))
+                chunks.clear()
+            else:
+                self._stream(decoder.decode(kept))
+
+    def _cap(self, data):
+        """The start of data within limits, counted as kept"""
+        _, max_bytes, max_lines = self.limits
+        keep = len(data)
+        if max_bytes:
+            keep = min(keep, max(0, max_bytes - self._kept_size))
+        if max_lines:
+            room = max(0, max_lines - self._kept_lines)  # Line breaks
+            if data.count(b'\n', 0, keep) >= room:
+                end = -1
+                for _ in range(room):
+                    end = data.find(b'\n', end + 1)
+                keep = end + 1
+        self._kept_size += keep
+        self._kept_lines += data.count(b'\n', 0, keep)
+        return data[:keep]
+
+    def _end_stream(self, fd):
+        """All of fd has been read"""
+        if fd == self._stdout_fd and self.spill is None and self.tail is None:
+            decoder = self._pipes[fd][1]
+            self._stream(decoder.decode(b'', final=True), final=True)
+
+    def _keep_tail(self, data):
+        if self.tail is None:
+            _, max_bytes, max_lines = self.limits
+            self.tail = spill.RingBuffer(self._marker_line(), self.encoding,
+                                        max_bytes, max_lines)
+        self.tail.write(data)
+        if self.on_output is not None:
+            self.on_output(self, self.tail)
+
+    def _marker_line(self):
+        """marker, shown in standout"""
+        return '\x1b[7m' + self.marker + '\x1b[0m'
+
+    def _spill(self, data):
+        if self.spill is None:
+            self.spill = spill.SpillFile(self.encoding)
+        self.spill.write(data)
+        if self.on_output is not None:
+            self.on_output(self, self.spill)
+
+    def _stream(self, text, final=False):
+        """Pass the complete lines of stdout read so far to on_output"""
+        if self.on_output is None:
+            return
+
+        # A trailing '\r' may be the first half of a '\r\n' split between
+        # reads
+        text = self._partial_line + text
+        held = ''
+        if text.endswith('\r') and not final:
+            text, held = text[:-1], '\r'
+        lines = self.line_break.split(text)
+
+        # The last line is incomplete unless it ends with a line break
+        self._partial_line = lines.pop() + held
+        if final and self._partial_line:
+            lines.append(self._partial_line)
+            self._partial_line = ''
+
+        if lines:
+            self.on_output(self, lines)
+
+    def _poll(self):
+        if self.popen.poll() is None:
+            self.event_loop.alarm(self.poll_interval, self._poll)
+            return
+        self._finish()
+
+    def _finish(self):
+        stdout_chunks = self._pipes[self._stdout_fd][2]
+        stderr_chunks = self._pipes[self._stderr_fd][2]
+        marker = self._marker_line().format(self.dropped)
+        if self.tail is not None:
+            self.stdout = self.tail.text()
+        elif self.spill is not None:
+            if self.dropped:
+                line_break = b'\n' if len(self.spill) > self.spill.newlines \
+                    else b''
+                self._spill(line_break + marker.encode(self.encoding) + b'\n')
+            self.stdout = self.spill
+        else:
+            self.stdout = self._decode(stdout_chunks)
+            if self.dropped:
+                self.stdout = self._add_line(self.stdout, marker)
+                if self.on_output is not None:
+                    self.on_output(self, [marker])
+        self.stderr = self._decode(stderr_chunks)
+        stderr_dropped = self._stderr_size - sum(map(len, stderr_chunks))
+        if stderr_dropped:
+            self.stderr = self._add_line(
+                self.stderr, self.marker.format(stderr_dropped))
+        self.returncode = self._wait()
+        spans.record('process', self._started, lane='process')
+        self.on_exit(self)
+
+    def _wait(self):
+        """The exit status"""
+        return self.popen.wait()
+
+    @staticmethod
+    def _add_line(text, line):
+        if text and not text.endswith('\n'):
+            text += '\n'
+        return text + line
+
+    def _decode(self, chunks):
+        text = b''.join(chunks).decode(self.encoding, errors='replace')
+        # Same newline handling as universal_newlines=True
+        return self.line_break.sub('\n', text)
+
+    @property
+    def running(self):
+        return self.returncode is None
+
+    @property
+    def dropped(self):
+        """Bytes of stdout not kept"""
+        if self.tail is not None:
+            return self.tail.dropped
+        return self.stdout_size - self._kept_size
+
+    def output_summary(self):
+        """Like '12,345 bytes of output, the first 1,000 kept', when stdout
+        was not all kept, or was moved to a file. Otherwise ''"""
+        if self.dropped:
+            part = 'last' if self.tail is not None else 'first'
+            kept = self.stdout_size - self.dropped
+            return (f"{self.stdout_size:,} bytes of output, "
+                    f"the {part} {kept:,} kept")
+        if self.spill is not None:
+            return f"{self.stdout_size:,} bytes of output, kept in a file"
+        return ''
+
+    def describe(self):
+        """The description of the result: output_summary(), after stderr
+        if the command failed"""
+        if self.returncode == 0:
+            return self.output_summary()
+        return '\n'.join(filter(None, (self.stderr.strip('\n'),
+                                        self.output_summary())))
+
+
+class ProcessRunner(object):
+    """Starts shell commands without blocking the user interface. Call setup
+    with the MainLoop instance after initialization. Until then, commands
+    are run to completion before run() returns. Output beyond
+    spill_threshold bytes is kept in a file, and output beyond limits, a
+    Limits, is not kept; see _Process."""
+
+    def __init__(self, spill_threshold=None, limits=None):
+        self.event_loop = None  # See setup()
+        self.spill_threshold = spill_threshold
+        self.limits = limits or Limits()
+
+    def setup(self, mainloop):
+        """Run commands on MainLoop.event_loop"""
+        self.event_loop = mainloop.event_loop
+
+    def run(self, cmd, on_exit, on_output=None, cwd=None):
+        """Start cmd in a shell, in directory cwd or the current one.
+        on_output(process, lines) is called with each batch of complete
+        stdout lines, and on_exit(process) is called when it has finished,
+        with returncode, stdout and stderr set on process."""
+        return _Process(self.event_loop, cmd, on_exit, on_output,
+                        self.spill_threshold, cwd, self.limits)
+
+
+class _SessionCommand(_Process):
+    """A command run by a ShellSession, which hands over its output"""
+
+    def __init__(self, session, cmd, on_exit, on_output=None,
+                 spill_threshold=None, cwd=None, limits=None):
+        self.session = session
+        self.status = None  # See _wait()
+        super(_SessionCommand, self).__init__(
+            session.event_loop, cmd, on_exit, on_output, spill_threshold,
+            cwd, limits)
+
+    def _start(self, cwd):
+        self._stdout_fd, self._stderr_fd = 1, 2  # Only keys of _pipes
+        self._add_pipe(self._stdout_fd)
+        self._add_pipe(self._stderr_fd)
+        self.session._send(self, cwd)
+
+    def _wait(self):
+        return self.status
+
+
+class ShellSession(object):
+    """One bash process kept for the session, running commands one at a time
+    like ProcessRunner.run(). Variables, functions and the directory carry
+    over from one command to the next, and bash is only started once.
+
+    Each command is sent over stdin, followed by sentinels on stdout and
+    stderr marking the end of its output, and a line with the exit status
+    and the shell's directory, which becomes process.exit_wd, on a pipe of
+    its own. A command that redirects or closes the shell's stdout or
+    stderr, e.g. 'exec >file', keeps a sentinel from arriving. Then bash is
+    stopped, to be started again by the next run(), and the command fails
+    with a message saying so. Call setup with the MainLoop instance after
+    initialization. Until then, while a command is running, and if bash
+    cannot be started, commands are run by runner, a ProcessRunner."""
+
+    shell = ['bash', '--noprofile', '--norc']
+    grace = 0.5  # Seconds to wait for the sentinels after the exit status
+    poll_interval = 0.05  # Seconds between polls for exit after a pipe closes
+    lost = ("The shell's output was redirected or closed. It has been "
+            "stopped, and a new one will run the next command.")
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.event_loop = None  # See setup()
+        self.popen = None  # Started by the first run()
+        self._command = None  # The _SessionCommand running
+        self._token = None  # Starts the sentinels of _command
+        self._marker = None  # The sentinel on stdout and stderr
+        self._keys = dict()  # {fd of bash: key of _command's pipe}
+        self._status_fd = None  # Read end of the pipe for exit statuses
+        self._status_write = None  # The number of its write end in bash
+        self._pending = dict()  # {fd: bytes read but not handed over}
+        self._ended = set()  # fds whose sentinel has been read
+        self._watches = dict()  # {fd of bash: watch handle}
+        self._alarm = None  # Waits for the sentinels, or for bash to exit
+        self._polls = None  # Left to wait for bash to exit; see _closed()
+        self._count = 0
+
+    def setup(self, mainloop):
+        """Read the output of bash on MainLoop.event_loop"""
+        self.event_loop = mainloop.event_loop
+
+    def run(self, cmd, on_exit, on_output=None, cwd=None):
+        """See ProcessRunner.run()"""
+        if self.event_loop is None or self._command is not None:
+            return self.runner.run(cmd, on_exit, on_output, cwd)
+        if self.popen is None:
+            try:
+                self._start_shell()
+            except OSError:
+                return self.runner.run(cmd, on_exit, on_output, cwd)
+        return _SessionCommand(self, cmd, on_exit, on_output,
+                               self.runner.spill_threshold,
+                               cwd or os.getcwd(), self.runner.limits)
+
+    def _start_shell(self):
+        status_fd, status_write = os.pipe()
+        try:
+            self.popen = subprocess.Popen(
+                self.shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, pass_fds=(status_write,))
+        except OSError:
+            os.close(status_fd)
+            raise
+        finally:
+            os.close(status_write)
+        self._status_write = status_write
+        self._status_fd = status_fd
+        pipes = ((self.popen.stdout.fileno(), 1),
+                 (self.popen.stderr.fileno(), 2), (status_fd, None))
+        for fd, key in pipes:
+            os.set_blocking(fd, False)
+            self._keys[fd] = key
+            self._pending[fd] = b''
+            self._watches[fd] = self.event_loop.watch_file(
+                fd, lambda fd=fd: self._read(fd))
+
+    def _send(self, command, cwd):
+        self._command = command
+        self._ended.clear()
+        self._count += 1
+        self._token = f"__winex_{secrets.token_hex(8)}_{self._count}"
+        self._marker = f"\n{self._token}\n".encode()
+        status = self._status_write
+        script = (f"cd -- {shlex.quote(cwd)} && "
+                  f"eval {shlex.quote(command.cmd)} </dev/null\n"
+                  "__winex_status=$?\n"
+                  f"printf '\\n%s\\n' {self._token}\n"
+                  f"printf '\\n%s\\n' {self._token} >&2\n"
+                  f"printf '%s %d %s\\n' {self._token} $__winex_status "
+                  f"\"$PWD\" >&{status}\n"
+                  "unset __winex_status\n")
+        try:
+            self.popen.stdin.write(
+                script.encode(command.encoding, errors='surrogateescape'))
+            self.popen.stdin.flush()
+        except OSError:  # bash has exited
+            self._exited()
+
+    def _read(self, fd):
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            self._closed(fd)
+            return
+        if fd == self._status_fd:
+            self._read_status(data)
+            return
+        if self._command is None or fd in self._ended:
+            return  # Not from a command run by run()
+
+        data = self._pending[fd] + data
+        end = data.find(self._marker)
+        if end == -1:
+            # The end of data may be the start of the marker
+            keep = len(self._marker)
+            self._pending[fd] = data[-keep:]
+            if len(data) > keep:
+                self._command._receive(self._keys[fd], data[:-keep])
+            return
+
+        self._pending[fd] = b''
+        self._command._receive(self._keys[fd], data[:end])
+        self._ended.add(fd)
+        if len(self._ended) == 2 and self._command.status is not None:
+            self._finish()
+
+    def _read_status(self, data):
+        """Take in the line with the exit status of the command"""
+        fd = self._status_fd
+        data = self._pending[fd] + data
+        line, line_break, rest = data.partition(b'\n')
+        self._pending[fd] = rest if line_break else data
+        if not line_break or self._command is None:
+            return
+        token, status, exit_wd = line.split(b' ', 2)
+        if token.decode() != self._token:
+            return
+        self._command.status = int(status)
+        self._command.exit_wd = os.fsdecode(exit_wd)
+        if len(self._ended) == 2:
+            self._finish()
+        elif self._polls is None:  # Unless waiting for bash to exit
+            self._alarm = self.event_loop.alarm(self.grace, self._lost)
+
+    def _lost(self):
+        """The output of bash is lost: the sentinels have not arrived
+        after the exit status, or a pipe was closed while bash runs"""
+        self._cancel_alarm()
+        command = self._command
+        self.close()
+        if command is not None:
+            self._hand_over_pending(command)
+            command._receive(2, b'\n' + self.lost.encode())
+            if not command.status:
+                command.status = 1
+        self._reset()
+        if command is not None:
+            self._finish(command)
+
+    def _closed(self, fd):
+        """A pipe from bash has been closed, as bash exited or as a
+        command closed it. bash is polled for from alarms, not to block the
+        interface, and has grace seconds to exit."""
+        handle = self._watches.pop(fd, None)
+        if handle is not None:
+            self.event_loop.remove_watch_file(handle)
+        if self._polls is None:
+            self._cancel_alarm()  # Waiting for bash to exit covers it
+            self._polls = max(1, round(self.grace / self.poll_interval))
+            self._poll()
+
+    def _poll(self):
+        self._alarm = None
+        if self.popen.poll() is not None:
+            self._exited()
+        elif self._polls == 0:
+            self._lost()
+        else:
+            self._polls -= 1
+            self._alarm = self.event_loop.alarm(
+                self.poll_interval, self._poll)
+
+    def _cancel_alarm(self):
+        if self._alarm is not None:
+            self.event_loop.remove_alarm(self._alarm)
+            self._alarm = None
+
+    def _hand_over_pending(self, command):
+        for fd, data in self._pending.items():
+            if fd not in self._ended and self._keys[fd] is not None:
+                command._receive(self._keys[fd], data)
+
+    def _finish(self, command=None):
+        self._cancel_alarm()
+        command = command or self._command
+        self._command = None
+        for key in (1, 2):
+            command._end_stream(key)
+        command._finish()
+
+    def _exited(self):
+        """bash has exited, e.g. on 'exit'. The command running, if any,
+        ends with the exit status of bash, which is started again by the
+        next run()."""
+        self.close()
+        command = self._command
+        if command is not None:
+            self._hand_over_pending(command)
+            command.status = self.popen.returncode
+        self._reset()
+        if command is not None:
+            self._finish(command)
+
+    def _reset(self):
+        """Forget the bash closed"""
+        self.popen = None
+        self._command = None
+        self._polls = None
+        self._pending.clear()
+        self._keys.clear()
+
+    def close(self):
+        """Stop reading from bash, and let it exit, stopping the command
+        running, if any"""
+        if self.popen is None:
+            return
+        for handle in self._watches.values():
+            self.event_loop.remove_watch_file(handle)
+        self._watches.clear()
+        for pipe in (self.popen.stdin, self.popen.stdout, self.popen.stderr):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        if self._status_fd is not None:
+            os.close(self._status_fd)
+            self._status_fd = None
+        if self.popen.poll() is None and self._command is not None:
+            self.popen.terminate()
+        self.popen.wait()
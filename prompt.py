@@ -4,18 +4,67 @@ import urwid
 import os
 import subprocess
 import re
+import functools
 
 import editor
-import dropdown
+import config
+import resultobject
+import spans
+
+
+@functools.lru_cache(maxsize=None)
+def _listings():
+    """Directory listings shared by the modes. Made when first used, like
+    the other costly parts of the prompt, to start up faster"""
+    import listing
+    return listing.ListingCache(
+        config.settings.getint('listing', 'cache_size'),
+        config.settings.getboolean('listing', 'inotify'))
+
+
+@functools.lru_cache(maxsize=None)
+def _completions():
+    """Directory indexes for auto completion, made when first used"""
+    import listing
+    return listing.CompletionIndex(
+        config.settings.getint('completion', 'cache_size'))
+
+
+@functools.lru_cache(maxsize=None)
+def _rewriter():
+    """Rewrites bash commands with the aliases and colors configured"""
+    import aliases
+    return aliases.CommandRewriter(dict(config.settings['aliases']),
+                                   dict(config.settings['colors']))
+
+
+class Foreground(object):
+    """The bash command running in the foreground, shared by the modes, as
+    one runs at a time whichever mode started it"""
+
+    def __init__(self):
+        self.proc = None
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.running
 
 
 class PromptEditor(editor.Editor):
+    signals = ['result', 'output', 'late_result', 'notice']
     mode_id = '---'
+    background = False  # Run bash commands as jobs? See run_bash_command()
+    background_pattern = re.compile(r'(.*?)\s*(?<!&)&\s*\Z', flags=re.DOTALL)
     eval_pattern = re.compile(
         r'(?:\s*)(:|\w+)(?:\s*)(.*)', flags=re.UNICODE)  # op, args
 
-    def __init__(self, resultobj, directory, edit_text):
+    def __init__(self, resultobj, runner, directory, edit_text, jobs=None,
+                 shell=None, foreground=None):
         self.resultobj = resultobj
+        self.runner = runner
+        self.jobs = jobs  # jobs.JobTable for background commands
+        self.shell = shell  # process.ShellSession for bash commands, if any
+        self.foreground = foreground or Foreground()
         self.change_mode = ''
         super(PromptEditor, self).__init__(
             caption=self._get_caption(directory), edit_text=edit_text)
@@ -26,22 +75,21 @@ class PromptEditor(editor.Editor):
         return [directory_map, mode_map]
 
     def update(self, directory=None, edit_text=""):
+        self.update_caption(directory)
+        self.set_edit_text("")
+        self.insert_text(edit_text)
+
+    def update_caption(self, directory=None):
         if directory is None:
             directory = os.path.basename(os.getcwd())
         self.set_caption(self._get_caption(directory))
-        self.set_edit_text("")
-        self.insert_text(edit_text)
 
     def reset_widget(self):
         self.set_edit_text("")
         self.change_mode = ''
 
     def get_standard_presentation(self):
-        proc = subprocess.run(
-            'ls -AhlgF --group-directories-first --color=always',
-            shell=True, universal_newlines=True,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        return proc.stdout
+        return _listings().get()
 
     def _evaluate(self):
         match = self.eval_pattern.match(self.edit_text)
@@ -98,66 +146,78 @@ class PromptEditor(editor.Editor):
         return False
 
     def run_bash_command(self, cmd):
-        def expand_alias(match):
-            if not match:
-                return None
-            if 'll' in match.groups():
-                return 'ls -AhlgF --group-directories-first'
-            if 'la' in match.groups():
-                return 'ls -Agp --group-directories-first'
-            if 'l' in match.groups():
-                return 'ls -Fp --group-directories-first'
-            if 't' in match.groups():
-                return 'tree --dirsfirst -FaL 2'
-            if 'g' in match.groups():
-                return 'grep'
-            if 'kll' in match.groups():
-                return 'pkill'
-            return None
-
-        def add_colors(match):
-            if not match:
-                return None
-            if 'tree' in match.groups():
-                return 'tree -C'
-            if 'ls' in match.groups():
-                return 'ls --color=always'
-            if 'grep' in match.groups():
-                return 'grep --color=always'
-            return None
-
-        alias_patterns = [
-            r'l[la]?',  # ls
-            r't',       # tree
-            r'g',       # grep
-            r'kll',     # pkill
-        ]
-
-        for ptrn in alias_patterns:
-            cmd = re.sub(
-                fr'((^{ptrn})(?!\S))|((?<=[|&;]\s)(?:\s*)({ptrn})(?!\S))',
-                expand_alias, cmd)
-
-        color_patterns = [r'tree', r'ls', r'grep']
-
-        for ptrn in color_patterns:
-            without_pipe = fr'((^{ptrn})(?!\S)(?!.*\|))'
-            with_pipe = fr'((?<=[|&;]\s)(?:\s*)({ptrn})(?!\S))'
-            cmd = re.sub(fr'{without_pipe}|{with_pipe}',
-                         add_colors, cmd)
-
-        proc = subprocess.run(
-            cmd, shell=True, universal_newlines=True,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        cmd = _rewriter().rewrite(cmd)
 
-        if proc.returncode == 0:
-            self.resultobj.set_result(
-                self.mode_id, self.edit_text, 'success',
-                presentation=proc.stdout)
-        else:
+        # 'cmd &' runs beside the command in the foreground
+        match = self.background_pattern.match(cmd)
+        if match or self.background:
+            self.run_background(match.group(1) if match else cmd)
+            return
+
+        # One command at a time in the foreground. The one running keeps
+        # resultobj, and the refusal is only a notice
+        if self.foreground.running:
+            self._emit('notice',
+                       f"Still running: '{self.foreground.proc.cmd}'")
+            return
+
+        # The command finishes after edit_text and cwd have moved on. Until
+        # then, resultobj is its own unless another result has replaced it
+        command = self.edit_text
+        exec_wd = os.getcwd()
+        self.resultobj.set_result(
+            self.mode_id, command, 'running', description=cmd)
+        running = resultobject.ResultObject()
+        running.copy_state(self.resultobj)
+
+        def output(proc, lines):
+            if self.resultobj == running:
+                self._emit('output', lines)
+
+        runner = self.runner if self.shell is None else self.shell
+        self.foreground.proc = runner.run(
+            cmd, lambda proc: self._bash_command_done(
+                proc, command, exec_wd, self.resultobj == running),
+            on_output=output)
+
+    def run_background(self, cmd):
+        if self.jobs is None:
             self.resultobj.set_result(
                 self.mode_id, self.edit_text, 'failure',
-                description=proc.stderr)
+                description="Background jobs are not available")
+            return
+        job = self.jobs.start(self.mode_id, self.edit_text, cmd, os.getcwd())
+        self.resultobj.set_result(
+            self.mode_id, self.edit_text, 'success',
+            description=f"[{job.number}] {job.status}: {cmd}")
+
+    def _bash_command_done(self, proc, command, exec_wd, current):
+        """Show the result of the command, if current, or else only add it
+        to the history, as the user has moved on"""
+        if self.foreground.proc is proc:
+            self.foreground.proc = None
+        resultobj = self.resultobj if current else \
+            resultobject.ResultObject()
+        if proc.returncode == 0:
+            resultobj.set_result(
+                self.mode_id, command, 'success',
+                description=proc.describe(),
+                presentation=proc.stdout, exec_wd=exec_wd)
+        else:
+            resultobj.set_result(
+                self.mode_id, command, 'failure',
+                description=proc.describe(), exec_wd=exec_wd)
+        if not current:
+            self._emit('late_result', resultobj)
+            return
+
+        # Follow the shell of a ShellSession into another directory
+        if proc.exit_wd and proc.exit_wd != exec_wd:
+            try:
+                os.chdir(proc.exit_wd)
+            except OSError:
+                pass
+        self._emit('result')
 
     def open_file(self, args):
         """Open file 'filename' in default application"""
@@ -219,6 +279,7 @@ class DefaultMode(PromptEditor):
             self._evaluate()
         return key
 
+    @spans.traced('evaluate')
     def _evaluate(self):
         if super(DefaultMode, self)._evaluate():
             return True
@@ -239,6 +300,7 @@ class BashMode(PromptEditor):
             self._evaluate()
         return key
 
+    @spans.traced('evaluate')
     def _evaluate(self):
         if super(BashMode, self)._evaluate():
             return True
@@ -246,18 +308,19 @@ class BashMode(PromptEditor):
         return True
 
 
+class BackgroundMode(BashMode):
+    mode_id = 'bg'
+    background = True
+
+
 class PromptWidgetHandler(urwid.PopUpLauncher):
-    signals = ['keypress']
+    signals = ['keypress', 'result', 'output', 'late_result', 'notice']
     modes = {DefaultMode.mode_id: DefaultMode,
-             BashMode.mode_id: BashMode}
-
-    def __init__(self, resultobj):
-        self.pop_up = dropdown.DropDown()
-        urwid.connect_signal(
-            self.pop_up, 'close', lambda x, key: self.close_pop_up(key))
-        urwid.connect_signal(
-            self.pop_up, 'render', lambda x: self._invalidate())
+             BashMode.mode_id: BashMode,
+             BackgroundMode.mode_id: BackgroundMode}
 
+    def __init__(self, resultobj, runner, jobs=None, shell=None):
+        self._pop_up = None  # See pop_up
         self.editor_status = ('', 0)  # (edit_text, edit_pos)
 
         # pop_up dimensionging and placement
@@ -267,8 +330,13 @@ class PromptWidgetHandler(urwid.PopUpLauncher):
         self.min_overlay_width = 13
         self.overlay_width = 1
         self.max_size = None  # (maxcol,) -- the size parameter to render()
+        self.prefetched_wd = None  # See prefetch_completions()
 
         self.resultobj = resultobj
+        self.runner = runner
+        self.jobs = jobs
+        self.shell = shell
+        self.foreground = Foreground()  # Shared by the modes
         self.editors = dict()
         super(PromptWidgetHandler, self).__init__(
             self._init_mode(DefaultMode.mode_id))
@@ -276,7 +344,17 @@ class PromptWidgetHandler(urwid.PopUpLauncher):
 
     def _init_mode(self, mode_id):
         directory = os.path.basename(os.getcwd())
-        editor = self.modes[mode_id](self.resultobj, directory, "")
+        editor = self.modes[mode_id](
+            self.resultobj, self.runner, directory, "", self.jobs,
+            self.shell, self.foreground)
+        urwid.connect_signal(editor, 'result', lambda x: self._emit('result'))
+        urwid.connect_signal(
+            editor, 'late_result',
+            lambda x, resultobj: self._emit('late_result', resultobj))
+        urwid.connect_signal(
+            editor, 'output', lambda x, lines: self._emit('output', lines))
+        urwid.connect_signal(
+            editor, 'notice', lambda x, text: self._emit('notice', text))
         self.editors[mode_id] = editor
         return editor
 
@@ -287,6 +365,34 @@ class PromptWidgetHandler(urwid.PopUpLauncher):
             else:
                 self.original_widget = self._init_mode(mode_id)
         self.original_widget.update(directory, edit_text)
+        self.prefetch_completions()
+
+    def follow_cwd(self):
+        """Show cwd in the caption, keeping the text being typed, and index
+        it for auto completion. For a command that changed cwd as it
+        finished, e.g. 'cd' in a process.ShellSession"""
+        self.original_widget.update_caption()
+        self.prefetch_completions()
+
+    def prefetch_completions(self):
+        """Index cwd and its subdirectories for auto completion, if cwd has
+        changed"""
+        cwd = os.getcwd()
+        if cwd != self.prefetched_wd:
+            self.prefetched_wd = cwd
+            _completions().prefetch(cwd)
+
+    @property
+    def pop_up(self):
+        """The auto complete drop down, made when first opened"""
+        if self._pop_up is None:
+            import dropdown
+            self._pop_up = dropdown.DropDown()
+            urwid.connect_signal(
+                self._pop_up, 'close', lambda x, key: self.close_pop_up(key))
+            urwid.connect_signal(
+                self._pop_up, 'render', lambda x: self._invalidate())
+        return self._pop_up
 
     def reset_widget(self):
         self.original_widget.reset_widget()
@@ -405,6 +511,7 @@ class PromptWidgetHandler(urwid.PopUpLauncher):
         self.max_size = size
         return super(PromptWidgetHandler, self).render(size, focus)
 
+    @spans.traced('set_pop_up_content')
     def set_pop_up_content(self):
         """Set auto complete content"""
 
@@ -414,9 +521,7 @@ class PromptWidgetHandler(urwid.PopUpLauncher):
                 dirname = os.path.dirname('./'+path)
                 if not os.path.isdir(dirname):
                     return list()
-            _, dirs, files = next(os.walk(dirname))
-            dirs = [d+'/' for d in dirs]
-            return dirs + files
+            return _completions().get(dirname)
 
         editor = self.original_widget
         cmd = editor.edit_text[:editor.edit_pos]
@@ -1,11 +1,17 @@
 import os
+import sys
 
 
 class ResultObject(object):
+    """The outcome of a command. One per history entry, so kept compact"""
+
+    __slots__ = ('mode_id', 'command', 'status', 'description',
+                 'presentation', 'exec_wd')
     status_map = {'init': "Initialized",
                   'success': "Success!",
                   'failure': "Failure!",
                   'error': "Error!",
+                  'running': "Running...",
                   'prompt': "Select option:"}
 
     def __init__(self):
@@ -14,7 +20,7 @@ class ResultObject(object):
         self.status = ''
         self.description = ''
         self.presentation = ''
-        self.cwd = ''
+        self.exec_wd = ''
 
     @property
     def parent_exec_wd(self):
@@ -27,11 +33,14 @@ class ResultObject(object):
     def set_result(self, mode_id, command, status, description='',
                    presentation='', exec_wd=''):
         assert status in self.status_map.keys()
-        self.mode_id = mode_id
+        self.mode_id = sys.intern(mode_id)
         self.command = command
-        self.status = status
+        self.status = sys.intern(status)
         self.description = description.strip('\n')
-        self.presentation = presentation.strip('\n')
+        # Either text, possibly with bash color codes, or a list of markup
+        if isinstance(presentation, str):
+            presentation = presentation.strip('\n')
+        self.presentation = presentation
         self.exec_wd = os.getcwd() if exec_wd == '' else exec_wd
 
     def copy_state(self, other):
@@ -43,3 +52,17 @@ class ResultObject(object):
         self.description = other.description
         self.presentation = other.presentation
         self.exec_wd = other.exec_wd
+
+    def __eq__(self, other):
+        if not isinstance(other, ResultObject):
+            return NotImplemented
+        # The presentation, possibly large, is compared last
+        return (self.command == other.command and
+                self.exec_wd == other.exec_wd and
+                self.mode_id == other.mode_id and
+                self.status == other.status and
+                self.description == other.description and
+                self.presentation == other.presentation)
+
+    def __hash__(self):
+        return hash((self.mode_id, self.command, self.status, self.exec_wd))
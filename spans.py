@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""Timing spans of the hot paths. Off unless enable() is called, and then
+the latest duration of each span is kept in latest, and the spans of the
+session in events, to be written as a Chrome trace with dump(), viewable
+in chrome://tracing or https://ui.perfetto.dev"""
+
+import os
+import json
+import time
+import functools
+import threading
+import collections
+
+enabled = False
+max_events = 1000000  # The most recent spans kept for dump()
+latest = collections.OrderedDict()  # {name: seconds}, most recent last
+events = collections.deque(maxlen=max_events)  # (name, start, end, lane)
+
+now = time.perf_counter_ns
+_origin = now()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def record(name, start, lane=None):
+    """Add the span name from start, a now() value, until now. Spans that
+    overlap those of the user interface, like a running command, are shown
+    in their own lane."""
+    if not enabled:
+        return
+    end = now()
+    latest[name] = (end - start) / 1e9
+    latest.move_to_end(name)
+    events.append((name, start, end, lane or threading.current_thread().name))
+
+
+def traced(name):
+    """Decorator recording each call of the function as span name"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = now()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, start)
+        return wrapper
+    return decorate
+
+
+def summary():
+    """The latest timings, most recent first, like 'render 1.2ms  evaluate
+    30.5ms'"""
+    return '  '.join(f"{name} {seconds * 1000:.1f}ms"
+                     for name, seconds in reversed(latest.items()))
+
+
+def dump(path):
+    """Write the spans recorded to path in the Chrome trace event format"""
+    pid = os.getpid()
+    trace_events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': lane,
+                     'ts': (start - _origin) / 1000,
+                     'dur': (end - start) / 1000}
+                    for name, start, end, lane in list(events)]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
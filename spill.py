@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import re
+import mmap
+import array
+import locale
+import hashlib
+import tempfile
+import threading
+import itertools
+import collections
+import collections.abc
+
+
+class _OutputLines(collections.abc.Sequence):
+    """Command output kept as bytes outside the list of output lines, for
+    which it stands in: len() and indexing give the lines as text. Lines
+    may be written while they are read by other threads."""
+
+    def __init__(self, encoding=None):
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self._lock = threading.Lock()
+
+    def _line(self, position):
+        """The bytes of the line at position, which is in range"""
+        raise NotImplementedError
+
+    def __getitem__(self, position):
+        with self._lock:
+            length = len(self)
+            if position < 0:
+                position += length
+            if not 0 <= position < length:
+                raise IndexError(position)
+            line = self._line(position)
+        return self._decode(line)
+
+    def _decode(self, line):
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line.decode(self.encoding, errors='replace')
+
+
+class SpillFile(_OutputLines):
+    """Command output kept in a temporary file instead of in memory, and
+    read back through mmap. The offsets of the lines are only found as far
+    as they are asked for. The file may keep growing with write() while it
+    is read. Once closed, its lines read as empty."""
+
+    index_step = 4096  # Lines to look ahead when extending the index
+    _newline = re.compile(b'\n')
+
+    def __init__(self, encoding=None):
+        super(SpillFile, self).__init__(encoding)
+        self.file = tempfile.TemporaryFile(prefix='winex-')
+        self.size = 0
+        self.newlines = 0
+        self._complete = True  # Does the last line have a line break?
+        self._mmap = None
+        self._mapped_size = 0
+        self._offsets = array.array('Q', [0])  # Start of each line found
+        self._hash = hashlib.blake2b(digest_size=16)  # Of the content
+        self.closed = False
+
+    def write(self, data):
+        if not data:
+            return
+        self.file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        self.newlines += data.count(b'\n')
+        self._complete = data.endswith(b'\n')
+
+    def __len__(self):
+        if self.size == 0 or self._complete:
+            return self.newlines
+        return self.newlines + 1  # The last line has no line break yet
+
+    def __bool__(self):
+        return self.size > 0
+
+    def _map(self):
+        if self._mapped_size == self.size:
+            return
+        self.file.flush()
+        if self._mmap is not None:
+            self._mmap.close()
+        self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_size = self.size
+
+    def _index(self, position):
+        """Find the start of line position + 1, if it has one"""
+        missing = position + 2 - len(self._offsets)
+        if missing <= 0:
+            return
+        matches = self._newline.finditer(self._mmap, self._offsets[-1])
+        self._offsets.extend(
+            match.end() for match in itertools.islice(
+                matches, missing + self.index_step))
+
+    def _line(self, position):
+        if self.closed:
+            return b''
+        self._map()
+        self._index(position)
+        start = self._offsets[position]
+        if position + 1 < len(self._offsets):
+            end = self._offsets[position + 1] - 1  # Without the '\n'
+        else:
+            end = self._mapped_size
+        return self._mmap[start:end]
+
+    def __repr__(self):
+        return f"<SpillFile {self.file.name}: {len(self)} lines>"
+
+    def content_digest(self):
+        """Hex digest of what has been written"""
+        return self._hash.hexdigest()
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+            self.file.close()
+            self.closed = True
+
+
+class RingBuffer(_OutputLines):
+    """The last lines of command output, at most max_bytes and max_lines (0
+    for no limit), kept in memory. Older lines are dropped as write() adds
+    new ones. The first line is made from marker, a format string, with
+    the number of bytes dropped."""
+
+    def __init__(self, marker, encoding=None, max_bytes=0, max_lines=0):
+        super(RingBuffer, self).__init__(encoding)
+        self.marker = marker
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.lines = collections.deque()  # Without the '\n'
+        self.partial = b''  # Written after the last line break
+        self.size = 0  # Bytes kept
+        self.dropped = 0  # Bytes dropped
+
+    def write(self, data):
+        if not data:
+            return
+        with self._lock:
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            self.lines.extend(lines)
+            self.size += len(data)
+            self._trim()
+
+    def _trim(self):
+        if self.max_bytes and len(self.partial) > self.max_bytes:
+            cut = len(self.partial) - self.max_bytes
+            self.partial = self.partial[cut:]
+            self._drop(cut)
+        while self.lines and (
+                self.max_bytes and self.size > self.max_bytes or
+                self.max_lines and
+                len(self.lines) + bool(self.partial) > self.max_lines):
+            self._drop(len(self.lines.popleft()) + 1)
+
+    def _drop(self, size):
+        self.size -= size
+        self.dropped += size
+
+    def __len__(self):
+        return 1 + len(self.lines) + bool(self.partial)
+
+    def _line(self, position):
+        if position == 0:
+            return self.marker.format(self.dropped).encode(self.encoding)
+        if position <= len(self.lines):
+            return self.lines[position - 1]
+        return self.partial
+
+    def text(self):
+        """All lines as one string"""
+        with self._lock:
+            lines = [self._line(position) for position in range(len(self))]
+        return '\n'.join(map(self._decode, lines))
+
+    def __repr__(self):
+        return f"<RingBuffer: {len(self)} lines, {self.dropped} dropped>"
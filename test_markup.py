@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+import markup
+
+
+def _mapper():
+    color_mapper = markup.ColorMapper()
+    color_mapper.register_palette_entry = lambda *args, **kwargs: None
+    return color_mapper
+
+
+def test_sub_parameter_after_256_color():
+    assert _mapper().get_markup('\x1b[38;5;1:2mtext') == [('', 'text')]
+
+
+def test_sub_parameter_in_24_bit_color():
+    assert _mapper().get_markup('\x1b[38;2;1;2;3:4mtext') == [('', 'text')]
+
+
+def test_colon_24_bit_color_with_color_space():
+    assert _mapper().get_markup('\x1b[38:2::255:0:0mtext') == \
+        [('38;5;196', 'text')]
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 
 import re
+import bisect
+import threading
+import collections
+import collections.abc
 import urwid
 
+import fuzzy
+import markup
+import spans
+
 
 class _CheckBox(urwid.CheckBox):
     def __init__(self, markup, *args, **kwargs):
@@ -35,83 +43,243 @@ class _Text(urwid.Text):
 
 
 class _Line(urwid.AttrMap):
+    """A line shown plain when in focus, and with its markup otherwise. The
+    canvases of both are kept until the width or the content changes, so
+    that lines are only laid out again when they have to be."""
+
     def __init__(self, w, focus_attr):
         super(_Line, self).__init__(w, attr_map=None, focus_map=focus_attr)
+        self._canvases = dict()  # {focus: canvas} at _canvas_size
+        self._canvas_size = None
+        if isinstance(w, urwid.CheckBox):
+            urwid.connect_signal(w, 'change', self.clear_canvases)
+
+    def clear_canvases(self, *args):
+        self._canvases.clear()
 
     def render(self, size, focus=False):
-        if focus:
-            self.original_widget.show_plain()
-        else:
-            self.original_widget.show_markup()
-        return super(_Line, self).render(size, focus)
+        if size != self._canvas_size:
+            self._canvases.clear()
+            self._canvas_size = size
+
+        canvas = self._canvases.get(focus)
+        if canvas is None:
+            if focus:
+                self.original_widget.show_plain()
+            else:
+                self.original_widget.show_markup()
+            canvas = super(_Line, self).render(size, focus)
+            self._canvases[focus] = canvas
+        return canvas
 
     def __getattr__(self, name):
         return object.__getattribute__(self.original_widget, name)
 
 
-class _Lines(urwid.SimpleListWalker):
+class _Lines(urwid.ListWalker):
+    """A list walker over a plain list of markup. Line widgets are only built
+    for the positions the ListBox asks for, and the most recently used are
+    kept in a small cache."""
+
+    cache_size = 256  # Must exceed the number of rows on screen
+
     def __init__(self, focus_attr):
         self.focus_attr = focus_attr
         self.checkbox = False
-        super(_Lines, self).__init__(list())
-
-    def set_content(self, markup_list, checkbox=False):
-        self.contents.clear()
+        self.contents = list()  # Markup; one item per line
+        self.make_markup = None  # See set_content()
+        self.checked = set()  # Positions of checked boxes
+        self.focus = 0
+        self._widgets = collections.OrderedDict()  # {position: _Line}
+
+    def set_content(self, markup_list, checkbox=False, make_markup=None):
+        """make_markup, if given, turns the items of markup_list into markup
+        when their lines are shown. Lists are copied, while other sequences,
+        e.g. a spill.SpillFile, are read from as lines are shown."""
+        if isinstance(markup_list, collections.abc.Sequence) and \
+           not isinstance(markup_list, list):
+            self.contents = markup_list
+        else:
+            self.contents = list(markup_list)
+        self.make_markup = make_markup
         self.checkbox = checkbox
+        self.checked.clear()
+        self._widgets.clear()
+        self.focus = 0
+        self._modified()
+
+    def append_content(self, markup_list):
+        self.contents.extend(markup_list)
+        self._modified()
+
+    def clear_cache(self):
+        self._widgets.clear()
+
+    def get_markup(self, position):
+        if self.make_markup is None:
+            return self.contents[position]
+        return self.make_markup(self.contents[position])
+
+    def get_string(self, position):
+        """The plain text of the line at position"""
+        markup = self.get_markup(position)
+        if isinstance(markup, str):
+            return markup
+        return urwid.util.decompose_tagmarkup(markup)[0]
+
+    def strings(self):
+        for position in range(len(self.contents)):
+            yield self.get_string(position)
+
+    def _toggle(self, position, w, state):
+        if state:
+            self.checked.add(position)
+        else:
+            self.checked.discard(position)
+
+    def __len__(self):
+        return len(self.contents)
 
-        for markup in markup_list:
-            w = _CheckBox(markup) if checkbox else _Text(markup)
-            self.contents.append(_Line(w, self.focus_attr))
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+
+        line = self._widgets.get(position)
+        if line is not None:
+            self._widgets.move_to_end(position)
+            return line
+
+        markup = self.get_markup(position)
+        if self.checkbox:
+            w = _CheckBox(markup, state=position in self.checked)
+            urwid.connect_signal(w, 'change', self._toggle,
+                                 user_args=[position])
+        else:
+            w = _Text(markup)
+        line = _Line(w, self.focus_attr)
+
+        self._widgets[position] = line
+        if len(self._widgets) > self.cache_size:
+            self._widgets.popitem(last=False)
+        return line
+
+    def next_position(self, position):
+        return position + 1
+
+    def prev_position(self, position):
+        return position - 1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.contents) - 1, -1, -1)
+        return range(len(self.contents))
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
 
     def get_selected_message(self):
         # Contains _Text objects. Return only text
         if not self.checkbox:
-            return self.get_focus().get_string()
+            return self.get_string(self.focus)
 
         # Contains _CheckBox objects. Return text of all checked boxes
         message = list()
-        for cb in self:
-            message.append(cb.get_string())
+        for position in sorted(self.checked):
+            message.append(self.get_string(position))
         return message
 
 
+class _Scan(threading.Thread):
+    """Finds the lines matching match() in the background, a chunk at a time.
+    The positions of the matches are appended to matches, in ascending
+    order, and notify() is called after each chunk. Lines added while
+    scanning are scanned too."""
+
+    chunk_size = 10000  # Lines scanned between calls of notify()
+    batch_size = 256  # Lines scanned between checks for cancel()
+
+    def __init__(self, lines, plain_text, match, notify):
+        super(_Scan, self).__init__(daemon=True)
+        self.lines = lines
+        self.plain_text = plain_text
+        self.match = match
+        self.notify = notify
+        self.matches = list()
+        self.scanned = 0  # Lines scanned so far
+        self.done = False
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def run(self):
+        lines, plain_text, match = self.lines, self.plain_text, self.match
+        notified = 0
+        while not self._cancelled.is_set():
+            end = min(self.scanned + self.batch_size, len(lines))
+            self.matches.extend(
+                position for position in range(self.scanned, end)
+                if match(plain_text(lines[position])) is not None)
+            self.scanned = end
+            self.done = end == len(lines)
+            if self.done or end - notified >= self.chunk_size:
+                notified = end
+                self.notify()
+            if self.done:
+                return
+
+
 class Walker(urwid.ListBox):
+    _metachars = set('.^$*+?{}[]\\|()')  # Regular expression syntax
+
     def __init__(self, markup_list=list(), checkbox=False,
                  focus_attr='infoline'):
         super(Walker, self).__init__(body=_Lines(focus_attr))
         self.original_body = self.body  # Used when calling filter_content()
+        self._scan = None  # See search()
         self.set_content(markup_list, checkbox)
 
-    def set_content(self, markup_list, checkbox=False):
+    @spans.traced('set_content')
+    def set_content(self, markup_list, checkbox=False, make_markup=None):
+        self.cancel_search()
         self.body = self.original_body
-        self.body.set_content(markup_list, checkbox)
+        self.body.set_content(markup_list, checkbox, make_markup)
         self._selectable = True if len(self.body) > 0 else False
 
+    def append_content(self, markup_list):
+        """Add lines to the end of the unfiltered content"""
+        self.original_body.append_content(markup_list)
+        self._selectable = True if len(self.original_body) > 0 else False
+
+    def refresh(self):
+        """The content sequence has changed in place, e.g. grown, or lost
+        lines at the start"""
+        self.original_body.clear_cache()
+        self.original_body._modified()
+        self._selectable = True if len(self.original_body) > 0 else False
+
+    @spans.traced('filter_content')
     def filter_content(self, search_pattern, attr_marked='', attr_plain=''):
         if search_pattern == '':
             self.body = self.original_body
             return
 
-        # Replace body with a new _Lines object containing the filtered list
-        filtered_list = list()
+        def make_markup(groups):
+            if not attr_marked:
+                return ''.join(groups)
+
+            left_str, match_str, right_str = groups
+            markup = [(attr_plain, left_str)]
+            markup += [(attr_marked, match_str)]
+            markup += [(attr_plain, right_str)]
+            return markup
+
+        # Markup is only made for the lines shown
         try:
-            pattern = re.compile(rf'(.*?)({search_pattern})(.*)',
-                                 flags=re.IGNORECASE | re.UNICODE)
-            for line in self.original_body:
-                match = pattern.match(line.get_string())
-                if match:
-                    if not attr_marked:
-                        filtered_list.append(match.group(0))
-                        continue
-
-                    left_str, match_str, right_str = match.groups()
-                    markup = [(attr_plain, left_str)]
-                    markup += [(attr_marked, match_str)]
-                    markup += [(attr_plain, right_str)]
-                    filtered_list.append(markup)
-
-            self.body = _Lines(self.body.focus_attr)
-            self.body.set_content(filtered_list, self.original_body.checkbox)
+            filtered_list = [groups for _, groups
+                             in self._find_matches(search_pattern)]
+            self.set_filtered_content(filtered_list, make_markup)
             return
 
         except re.error:
@@ -120,20 +288,131 @@ class Walker(urwid.ListBox):
             pass
         self.body = self.original_body
 
+    def set_filtered_content(self, filtered_list, make_markup=None):
+        """Show filtered_list in place of the content, until the next
+        set_content() or filter_content('')"""
+        # Replace body with a new _Lines object containing the filtered list
+        self.body = _Lines(self.body.focus_attr)
+        self.body.set_content(filtered_list, self.original_body.checkbox,
+                              make_markup)
+
     def has_match(self, search_str):
         try:
-            pattern = re.compile(rf'(.*?)({search_str})(.*)',
-                                 flags=re.IGNORECASE | re.UNICODE)
-            for line in self.original_body:
-                if pattern.search(line.get_string()):
-                    return True
+            match = self._matcher(search_str)
         except re.error:
-            pass
-
-        return False
+            return False
+        get_string = self.original_body.get_string
+        return any(match(get_string(position)) is not None
+                   for position in range(len(self.original_body)))
+
+    def _find_matches(self, search_pattern):
+        """Returns [(position, (left_str, match_str, right_str))] for the
+        lines in original_body matching search_pattern. Raises re.error."""
+        get_string = self.original_body.get_string
+        match = self._matcher(search_pattern)
+        matches = list()
+        for position in range(len(self.original_body)):
+            groups = match(get_string(position))
+            if groups is not None:
+                matches.append((position, groups))
+        return matches
+
+    def _matcher(self, search_pattern):
+        """A function of a string returning its (left_str, match_str,
+        right_str) if it matches search_pattern, case insensitively, and
+        otherwise None. Raises re.error."""
+        if not self._metachars.intersection(search_pattern):
+            # Plain substring search is much faster than re
+            needle = fuzzy.lower(search_pattern)
+            length = len(needle)
+
+            def match(string):
+                start = fuzzy.lower(string).find(needle)
+                if start == -1:
+                    return None
+                end = start + length
+                return string[:start], string[start:end], string[end:]
+            return match
+
+        pattern = re.compile(rf'(.*?)({search_pattern})(.*)',
+                             flags=re.IGNORECASE | re.UNICODE)
+
+        def match(string):
+            match = pattern.match(string)
+            return match.groups() if match else None
+        return match
+
+    def search(self, search_pattern, notify=None):
+        """Find the lines matching search_pattern, as filter_content() does,
+        in a background thread, without filtering the content. The positions
+        of the matches found so far are in search_matches, and notify() is
+        called from the thread as the search makes progress. Without notify,
+        all matches are found before search() returns."""
+        self.cancel_search()
+        self.body = self.original_body
+        try:
+            match = self._matcher(search_pattern)
+        except re.error:
+            return
+        # The text of colored output is that of its raw lines, which are
+        # read without making their markup
+        lines = self.original_body.contents
+        if isinstance(lines, markup.MarkupLines):
+            lines = lines.lines
+        self._scan = _Scan(lines, self.plain_text, match,
+                           notify or (lambda: None))
+        if notify is None:
+            self._scan.run()
+        else:
+            self._scan.start()
+
+    def cancel_search(self):
+        if self._scan is not None:
+            self._scan.cancel()
+            self._scan = None
+
+    @property
+    def search_matches(self):
+        return self._scan.matches if self._scan is not None else list()
+
+    @property
+    def search_done(self):
+        return self._scan is None or self._scan.done
+
+    def next_match(self, step=1, position=None):
+        """Focus the next match of search() after position, or the previous
+        one if step is negative, wrapping around at the ends. position
+        defaults to the focus position. Returns False if there are no
+        matches."""
+        matches = self.search_matches
+        if not matches:
+            return False
+        if position is None:
+            position = self.focus_position
+        if step > 0:
+            idx = bisect.bisect_right(matches, position)
+            position = matches[idx] if idx < len(matches) else matches[0]
+        else:
+            idx = bisect.bisect_left(matches, position) - 1
+            position = matches[idx]  # Wraps to the last at -1
+        self.set_focus(position)
+        self._invalidate()
+        return True
+
+    @staticmethod
+    def plain_text(item):
+        """The text of an item of the content, without markup. Called from
+        the search() thread, so must not touch the widget. Raw lines of
+        output, e.g. of a spill.SpillFile, lose their control sequences."""
+        if isinstance(item, str):
+            if '\x1b' in item:
+                return markup.ColorMapper.csi_pattern.sub('', item)
+            return item
+        return urwid.util.decompose_tagmarkup(item)[0]
 
     def set_focus_attr(self, attr):
         self.body.focus_attr = attr
+        self.body.clear_cache()
 
     def get_focus_attr(self):
         return self.body.focus_attr
@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 
+import time
+started = time.perf_counter()  # Before the imports; see --profile-startup
+
 import os
+# Most of the import time is urwid's, about 260 ms, as it imports trio and
+# asyncio for its event loops. The modules of winex take about 15 ms, and
+# build the first frame, so they are not deferred; historylog, listing,
+# dropdown and aliases are imported when first used.
 import urwid
 from palette import palette
 import resultobject
@@ -9,29 +16,49 @@ import prompt
 import presentation
 import cmdhistory
 import markup
+import process
+import jobs
+import config
+import spans
 
 
 class TextUserInterface(urwid.Frame):
-    def __init__(self, get_markup):
-        self.get_markup = get_markup
+    def __init__(self, color_mapper, runner, shell=None):
+        self.color_mapper = color_mapper
         self.resultobj = resultobject.ResultObject()
 
+        # Commands run in the background, shown below the result when any
+        self.jobs = jobs.JobsWidget(jobs.JobTable(
+            runner, config.settings.getint('jobs', 'max_running'),
+            lambda job: self.receive_job(job)))
+
         # The 'header' widget
         self.parent_directory = infoline.ParentDirectoryWidget()
-        self.prompt = prompt.PromptWidgetHandler(self.resultobj)
+        self.prompt = prompt.PromptWidgetHandler(
+            self.resultobj, runner, self.jobs.table, shell)
+        if config.problems:  # In the user's winex.conf
+            self.resultobj.set_result(
+                self.resultobj.mode_id, "", 'failure',
+                description='\n'.join(config.problems))
         self.result = infoline.ResultWidget(
             'init', resultobject.ResultObject.status_map)
         header = urwid.Pile(
             [self.parent_directory, self.prompt, urwid.Divider(), self.result])
 
         # The 'body' and 'footer' widgets
-        self.presentation = presentation.PresentationWidget(get_markup)
-        self.session = infoline.SessionInfo(cut_pos=-1, string="")
+        self.presentation = presentation.PresentationWidget(color_mapper)
+        self.streaming = False  # Is presentation showing a running command?
+        self.search = presentation.SearchWidget(self.presentation)
+        self.session = infoline.SessionInfo(cut_pos=-1)
 
         # The cmd_history widget
         self.history_resultobj = resultobject.ResultObject()
-        self.cmd_history = cmdhistory.CmdHistoryWidget(self.history_resultobj)
+        self.cmd_history = cmdhistory.CmdHistoryWidget(
+            self.history_resultobj, None,  # See finish_startup()
+            config.settings.getint('history', 'load_size'))
         self.cmd_history.add(self.resultobj)
+        self.waiting = list()  # For the history; see add_to_history()
+        self.notice = None  # Shown in place of the result, once
 
         # Setting initial content
         self.parent_directory.update()
@@ -45,15 +72,114 @@ class TextUserInterface(urwid.Frame):
 
         urwid.connect_signal(self.prompt, 'keypress',
                              lambda x, size, key: self.keypress(size, key))
+        urwid.connect_signal(self.prompt, 'result',
+                             lambda x: self.receive_result())
+        urwid.connect_signal(self.prompt, 'output',
+                             lambda x, lines: self.receive_output(lines))
+        urwid.connect_signal(
+            self.prompt, 'late_result',
+            lambda x, resultobj: self.add_to_history(resultobj))
+        urwid.connect_signal(self.prompt, 'notice',
+                             lambda x, text: self.receive_notice(text))
+
+    def setup(self, mainloop):
+        """Call finish_startup() once mainloop has drawn the first frame.
+        Results enter the history once the frame showing them is drawn"""
+        after_next_paint(mainloop, self.finish_startup)
+        self.cmd_history.history.defer = \
+            lambda callback: after_next_paint(mainloop, callback)
+
+    def finish_startup(self):
+        """Read the command history and index cwd for auto completion, which
+        the first frame can do without"""
+        import historylog
+        self.cmd_history.attach(historylog.open_log())
+        self.prompt.prefetch_completions()
+
+    @spans.traced('render')
+    def render(self, size, focus=False):
+        return super(TextUserInterface, self).render(size, focus)
+
+    def show_timings(self):
+        """Show the latest timings in the footer, when tracing"""
+        if spans.enabled:
+            self.session.update(spans.summary())
+
+    def show_result(self, update_presentation=True):
+        # Running commands enter the history when they finish
+        if self.resultobj.status != 'running':
+            self.cmd_history.add(self.resultobj)
+        self.parent_directory.update()
+        self.result.update(self.resultobj.status,
+                           self.resultobj.description)
+
+        # Output from running commands is added by receive_output()
+        self.streaming = self.resultobj.status == 'running'
+        if update_presentation or self.streaming:
+            self.presentation.update(self.resultobj.presentation,
+                                     force=self.streaming)
+
+    def receive_output(self, lines):
+        """Lines of output from a running command have arrived"""
+        if self.streaming and self.resultobj.status == 'running':
+            self.presentation.append(lines)
+
+    def receive_result(self):
+        """A command started from the prompt has finished"""
+        # Do not disturb browsing; the result is shown on leaving history
+        if self.footer is self.cmd_history:
+            self.add_to_history(self.resultobj)
+            return
+
+        # The output is already presented if it was streamed
+        self.show_result(update_presentation=not self.streaming)
+        self.prompt.follow_cwd()
+        self.show_timings()
+
+    def receive_notice(self, text):
+        """The prompt refused a command, leaving the result as it is. The
+        notice is shown until the result changes"""
+        self.notice = text
+
+    def receive_job(self, job):
+        """A background job has started or is done. Jobs done enter the
+        history, where their output can be seen"""
+        if job.status == 'done':
+            self.add_to_history(job.resultobj)
+        self.show_jobs()
+
+    def add_to_history(self, resultobj):
+        """Add a finished command to the history. While the history is
+        browsed, it waits until browsing ends, not to move the selection"""
+        if self.footer is self.cmd_history:
+            entry = resultobject.ResultObject()
+            entry.copy_state(resultobj)
+            self.waiting.append(entry)
+        else:
+            self.cmd_history.history.add(resultobj)
+
+    def add_waiting(self):
+        for resultobj in self.waiting:
+            self.cmd_history.history.add(resultobj)
+        self.waiting.clear()
+
+    def show_jobs(self):
+        self.jobs.update()
+        contents = self.header.contents
+        shown = contents[-1][0] is self.jobs
+        if len(self.jobs) > 0 and not shown:
+            contents.append((self.jobs, self.header.options()))
+        elif len(self.jobs) == 0 and shown:
+            del contents[-1]
 
     def keypress_prompt(self, key):
         if key == 'enter':
-            self.cmd_history.add(self.resultobj)
-            self.parent_directory.update()
             self.prompt.update()
-            self.result.update(self.resultobj.status,
-                               self.resultobj.description)
-            self.presentation.update(self.resultobj.presentation)
+            if self.notice is None:
+                self.show_result()
+            else:
+                self.result.update('failure', self.notice)
+                self.notice = None
 
         elif key == 'esc':
             self.prompt.update()
@@ -67,6 +193,7 @@ class TextUserInterface(urwid.Frame):
 
     def keypress_cmd_history(self, key):
         if key in ('up', 'down', 'enter', 'backspace') or len(key) == 1:
+            self.streaming = False
             self.parent_directory.update(
                 self.history_resultobj.parent_exec_wd)
             self.prompt.update(self.history_resultobj.mode_id,
@@ -77,6 +204,10 @@ class TextUserInterface(urwid.Frame):
             self.presentation.update(self.history_resultobj.presentation,
                                      force=True)
 
+        # Browsing ends
+        if key in ('esc', 'enter', 'tab'):
+            self.add_waiting()
+
         # Re-enter history item by inheriting mode_id, cwd, edit_text
         if key == 'enter':
             exec_wd = self.history_resultobj.exec_wd
@@ -118,6 +249,14 @@ class TextUserInterface(urwid.Frame):
             self.footer = self.session
             self.set_focus('header')
 
+    def keypress_search(self, key):
+        # 'enter' keeps the matches for 'n' and 'N'
+        if key == 'esc':
+            self.search.reset_widget()
+        if key in ('esc', 'enter'):
+            self.footer = self.session
+            self.set_focus('body')
+
     def keypress(self, size, key):
         super(TextUserInterface, self).keypress(size, key)
 
@@ -129,6 +268,15 @@ class TextUserInterface(urwid.Frame):
             if self.footer is self.cmd_history:
                 self.cmd_history.reset_widget()
                 self.footer = self.session
+                self.add_waiting()
+            elif self.footer is self.search:
+                self.search.reset_widget()
+                self.footer = self.session
+
+        # Remove the jobs done from view
+        elif key == 'meta j':
+            self.jobs.table.clear_done()
+            self.show_jobs()
 
         # Focus presentation widget
         elif key == 'meta w' and self.presentation.selectable():
@@ -144,21 +292,110 @@ class TextUserInterface(urwid.Frame):
         if self.get_focus() == 'header':
             self.keypress_prompt(key)
 
+        # Search presentation
+        elif key == '/' and self.get_focus() == 'body':
+            self.search.set_edit_text("")
+            self.footer = self.search
+            self.set_focus('footer')
+            return key
+
+        # Jump between search matches
+        elif key in ('n', 'N') and self.get_focus() == 'body':
+            self.presentation.next_match(+1 if key == 'n' else -1)
+
         # Focus is on cmd_history
-        if self.get_focus() == 'footer':
+        if self.get_focus() == 'footer' and self.footer is self.cmd_history:
             self.keypress_cmd_history(key)
 
+        # Focus is on search
+        elif self.get_focus() == 'footer' and self.footer is self.search:
+            self.keypress_search(key)
+
+        self.show_timings()
         return key
 
 
+def after_next_paint(mainloop, callback):
+    """Call callback once, after mainloop has drawn the next frame. The
+    frame is drawn before the event loop next goes idle, and the callback
+    is called from an alarm set then."""
+    handle = None
+    scheduled = False
+
+    def entering_idle():
+        nonlocal scheduled
+        if not scheduled:
+            scheduled = True
+            mainloop.event_loop.alarm(0, call)
+
+    def call():
+        mainloop.event_loop.remove_enter_idle(handle)
+        callback()
+
+    handle = mainloop.event_loop.enter_idle(entering_idle)
+
+
 if __name__ == '__main__':
+    import argparse
+
     def direct_quit(key):
         if key == 'meta q':
             raise urwid.ExitMainLoop()
 
+    parser = argparse.ArgumentParser(description="Windows Exploder")
+    parser.add_argument(
+        '--trace', nargs='?', const='', metavar='FILE',
+        help="time the hot paths and show the latest timings in the footer."
+        " With FILE, write the session's timings there as a Chrome trace")
+    parser.add_argument(
+        '--profile-startup', action='store_true',
+        help="exit as soon as started, and show how long each step took")
+    args = parser.parse_args()
+    if args.trace is not None:
+        spans.enable()
+
+    steps = [('imports', started, time.perf_counter())]  # (step, start, end)
     color_mapper = markup.ColorMapper()
-    widget = TextUserInterface(color_mapper.get_markup)
+    output = config.settings['output']
+    runner = process.ProcessRunner(
+        output.getint('spill_threshold'),
+        process.Limits(output['policy'], output.getint('max_bytes'),
+                       output.getint('max_lines')))
+    shell = None
+    if config.settings.getboolean('shell', 'persistent'):
+        shell = process.ShellSession(runner)
+    widget = TextUserInterface(color_mapper, runner, shell)
     mainloop = urwid.MainLoop(
         widget, palette=palette, unhandled_input=direct_quit, pop_ups=True)
     color_mapper.setup(mainloop)
-    mainloop.run()
+    runner.setup(mainloop)
+    if shell is not None:
+        shell.setup(mainloop)
+    widget.presentation.setup(mainloop)
+
+    if args.profile_startup:
+        # Before widget.finish_startup(), and then after it
+        def first_paint():
+            steps.append(('first paint', steps[-1][2], time.perf_counter()))
+            after_next_paint(mainloop, finished)
+
+        def finished():
+            steps.append(('deferred', steps[-1][2], time.perf_counter()))
+            raise urwid.ExitMainLoop()
+        after_next_paint(mainloop, first_paint)
+
+    widget.setup(mainloop)
+    steps.append(('interface', steps[-1][2], time.perf_counter()))
+
+    try:
+        mainloop.run()
+    finally:
+        if shell is not None:
+            shell.close()
+        if args.trace:
+            spans.dump(args.trace)
+
+    if args.profile_startup:
+        for step, start, end in steps:
+            print(f"{step:<12}{(end - start) * 1000:8.1f} ms")
+        print(f"{'total':<12}{(steps[-1][2] - started) * 1000:8.1f} ms")